@@ -1,20 +1,46 @@
 from datetime import datetime
+import hmac
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, Response, \
+    stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy.orm import joinedload
 
-from auth.auth import requires_auth, AuthError
+from auth.auth import requires_auth, check_principal, AuthError, \
+    authenticate, get_token_auth_header
 
-from database.models import setup_db
+from database.models import setup_db, db
+from database.pool import pool_stats
 from database.models import Author
 from database.models import Book
+from database.models import BULK_MAX_ITEMS, MAX_ID
+from database.changes import get_changes, InvalidToken
+from database.filters import BOOK_LISTING, AUTHOR_BOOK_LISTING, \
+    AUTHOR_LISTING, FilterError
+from database.fieldsets import BOOK_FIELDSET, AUTHOR_FIELDSET, \
+    FieldsetError
+from database.search import search_books, search_authors, SearchError
+from database.pagination import Page, PaginationError, MAX_PAGE_SIZE
+from cache.cache import setup_cache
+from cache.conditional import conditional
+from serialization.serialization import setup_json
+from metrics.metrics import setup_metrics
+from metrics.profiler import setup_profiler
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+
+    if test_config is not None:
+        app.config.update(test_config)
+
     setup_db(app)
+    cache = setup_cache(app)
+    setup_json(app)
+    metrics = setup_metrics(app)
+    setup_profiler(app)
 
     CORS(app, resources={r"/*": {"origins": "*"}})
 
@@ -29,6 +55,91 @@ def create_app(test_config=None):
         except ValueError:
             return False
 
+    def parse_date(date_string):
+
+        if not isinstance(date_string, str):
+            return None
+
+        try:
+            return datetime.strptime(date_string, '%Y/%m/%d').date()
+        except ValueError:
+            return None
+
+    def is_blank(value):
+        return not isinstance(value, str) or value.strip() == ""
+
+    def get_bulk_items(key):
+        body = request.get_json(silent=True)
+
+        if isinstance(body, dict):
+            body = body.get(key)
+
+        if not isinstance(body, list) or not body \
+                or len(body) > BULK_MAX_ITEMS:
+            abort(400)
+
+        return body
+
+    def get_bulk_ids(body):
+        ids = body.get('ids') if isinstance(body, dict) else None
+
+        if not isinstance(ids, list) or not ids \
+                or len(ids) > BULK_MAX_ITEMS \
+                or not all(type(item_id) is int and 1 <= item_id <= MAX_ID
+                           for item_id in ids):
+            abort(400)
+
+        return set(ids)
+
+    def bulk_errors(errors):
+        return jsonify({
+            "success": False,
+            "error": 400,
+            "message": "Bad Request",
+            "errors": errors
+        }), 400
+
+    def get_requested_ids():
+        """Parse ``?ids=1,2,3`` keeping request order, or return None."""
+        ids = request.args.get('ids')
+
+        if ids is None:
+            return None
+
+        try:
+            ids = [int(item_id) for item_id in ids.split(',')]
+        except ValueError:
+            abort(400)
+
+        if len(ids) > MAX_PAGE_SIZE \
+                or not all(1 <= item_id <= MAX_ID for item_id in ids):
+            abort(400)
+
+        return list(dict.fromkeys(ids))
+
+    def get_page():
+        page = Page.from_args(request.args)
+
+        # Unbounded pages are for admins; everyone else uses the exports
+        if page.limit is None:
+            check_principal('get:all', g.principal)
+        return page
+
+    def ndjson_response(rows, lines_per_chunk=500):
+        def generate():
+            dumps = app.json.dumps
+            chunk = []
+            for row in rows:
+                chunk.append(dumps(row))
+                if len(chunk) >= lines_per_chunk:
+                    yield '\n'.join(chunk) + '\n'
+                    chunk = []
+            if chunk:
+                yield '\n'.join(chunk) + '\n'
+
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
@@ -41,47 +152,177 @@ def create_app(test_config=None):
     def test():
         return jsonify({'status': 'Running...'}), 200
 
+    @app.route('/cache/stats')
+    @requires_auth("get:stats")
+    def cache_stats(payload):
+        return jsonify(cache.stats()), 200
+
+    @app.route('/db/pool/stats')
+    @requires_auth("get:stats")
+    def db_pool_stats(payload):
+        return jsonify(pool_stats(db.engine)), 200
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        if metrics is None:
+            abort(404)
+
+        # Scrapers send the static METRICS_TOKEN, people a get:stats JWT
+        token = get_token_auth_header()
+        expected = app.config['METRICS_TOKEN']
+        if not expected or not hmac.compare_digest(token.encode(),
+                                                   expected.encode()):
+            check_principal('get:stats', authenticate(token))
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    @app.route('/db/replicas/stats')
+    @requires_auth("get:stats")
+    def db_replica_stats(payload):
+        router = app.extensions.get('replica_router')
+        if router is None:
+            return jsonify({'replicas': 0}), 200
+        return jsonify(router.stats()), 200
+
     @app.route('/authors', methods=['GET'])
     @requires_auth("get:authors")
+    @conditional('authors', 'books')
+    @cache.cached('authors', 'books')
     def get_authors(payload):
-        authors_data = Author.query.all()
+        author_ids = get_requested_ids()
+
+        if author_ids is not None:
+            found = Author.get_many(author_ids)
+            authors_data = [found[author_id] for author_id in author_ids
+                            if author_id in found]
 
-        authors = [author.short() for author in authors_data]
+            return jsonify({
+                "success": True,
+                "authors": Author.long_many(authors_data),
+                "missing": [author_id for author_id in author_ids
+                            if author_id not in found]
+            }), 200
+
+        selection = AUTHOR_FIELDSET.select(request.args)
+        authors_data, next_cursor = AUTHOR_LISTING.apply(
+            get_page(), selection.query(), request.args)
+        authors = selection.render(authors_data)
 
         return jsonify({
             "success": True,
-            "authors": authors
+            "authors": authors,
+            "next_cursor": next_cursor
         }), 200
 
     @app.route('/books', methods=['GET'])
     @requires_auth("get:books")
+    @conditional('books', 'authors')
+    @cache.cached('books', 'authors')
     def get_books(payload):
-        books_data = Book.query.all()
+        book_ids = get_requested_ids()
+
+        if book_ids is not None:
+            found = Book.get_many(book_ids)
 
-        books = [book.short() for book in books_data]
+            return jsonify({
+                "success": True,
+                "books": [found[book_id].long() for book_id in book_ids
+                          if book_id in found],
+                "missing": [book_id for book_id in book_ids
+                            if book_id not in found]
+            }), 200
+
+        selection = BOOK_FIELDSET.select(request.args)
+        books_data, next_cursor = BOOK_LISTING.apply(
+            get_page(), selection.query(), request.args)
+        books = selection.render(books_data)
 
         return jsonify({
             "success": True,
-            "books": books
+            "books": books,
+            "next_cursor": next_cursor
         }), 200
 
+    @app.route('/books/export', methods=['GET'])
+    @requires_auth("get:books")
+    def export_books(payload):
+        return ndjson_response(Book.export_rows())
+
+    @app.route('/authors/export', methods=['GET'])
+    @requires_auth("get:authors")
+    def export_authors(payload):
+        return ndjson_response(Author.export_rows())
+
+    @app.route('/books/search', methods=['GET'])
+    @requires_auth("get:books")
+    @conditional('books', 'authors')
+    @cache.cached('books')
+    def get_books_search(payload):
+        books_data, next_cursor = search_books(get_page(),
+                                               request.args.get('q'))
+
+        return jsonify({
+            "success": True,
+            "books": [book.short() for book in books_data],
+            "next_cursor": next_cursor
+        }), 200
+
+    @app.route('/authors/search', methods=['GET'])
+    @requires_auth("get:authors")
+    @conditional('authors')
+    @cache.cached('authors')
+    def get_authors_search(payload):
+        authors_data, next_cursor = search_authors(get_page(),
+                                                   request.args.get('q'))
+
+        return jsonify({
+            "success": True,
+            "authors": [author.short() for author in authors_data],
+            "next_cursor": next_cursor
+        }), 200
+
+    @app.route('/changes', methods=['GET'])
+    @requires_auth("get:books")
+    def get_catalog_changes(payload):
+        # The feed carries full author rows as well as books
+        check_principal('get:authors', g.principal)
+        limit = get_page().limit or MAX_PAGE_SIZE
+
+        try:
+            changes = get_changes(request.args.get('since'), limit)
+        except InvalidToken:
+            return abort(400)
+
+        return jsonify(dict(changes, success=True)), 200
+
     @app.route('/books/author/<int:author_id>', methods=['GET'])
     @requires_auth("get:books_by_author")
+    @conditional('books', 'authors')
+    @cache.cached('author:{author_id}', 'author-details')
     def get_books_by_author(payload, author_id):
+        page = get_page()
+        selection = BOOK_FIELDSET.select(request.args)
         author = Author.query.get(author_id)
 
         if author is None:
             return abort(404)
 
-        books = [book.short() for book in author.books]
+        books_data, next_cursor = AUTHOR_BOOK_LISTING.apply(
+            page, selection.query().filter(Book.author_id == author_id),
+            request.args)
+
+        books = selection.render(books_data)
 
         return jsonify({
             "success": True,
-            "books": books
+            "books": books,
+            "next_cursor": next_cursor
         }), 200
 
     @app.route('/authors/<int:author_id>', methods=['GET'])
     @requires_auth("get:authors_detail")
+    @conditional('authors', 'books')
+    @cache.cached('author:{author_id}', 'author-details')
     def get_author_detail(payload, author_id):
         existed_author = Author.query.get(author_id)
 
@@ -95,8 +336,11 @@ def create_app(test_config=None):
 
     @app.route('/books/<int:book_id>', methods=['GET'])
     @requires_auth("get:books_detail")
+    @conditional('books', 'authors')
+    @cache.cached('book:{book_id}', 'book-details')
     def get_book_detail(payload, book_id):
-        existed_book = Book.query.get(book_id)
+        existed_book = Book.query.options(
+            joinedload(Book.author)).get(book_id)
 
         if existed_book is None:
             return abort(404)
@@ -120,12 +364,13 @@ def create_app(test_config=None):
             return abort(400)
 
         try:
-            author = Author(name, full_name, dob)
+            author = Author(name, full_name, parse_date(dob))
             author.insert()
+            cache.invalidate('authors')
 
             return jsonify({
                 "success": True,
-                "authors": [author.long()]
+                "authors": [author.long(number_of_books=0)]
             }), 200
         except Exception as e:
             print(e)
@@ -152,8 +397,10 @@ def create_app(test_config=None):
 
         try:
 
-            book = Book(title, description, release_date, author_id)
+            book = Book(title, description, parse_date(release_date),
+                        author_id)
             book.insert()
+            cache.invalidate('books', 'author:%s' % author_id)
 
             return jsonify({
                 "success": True,
@@ -164,6 +411,106 @@ def create_app(test_config=None):
             print(e)
             abort(422)
 
+    @app.route('/authors/bulk', methods=['POST'])
+    @requires_auth("post:authors")
+    def post_authors_bulk(payload):
+        items = get_bulk_items('authors')
+
+        rows = []
+        errors = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors.append({"index": index, "message": "Not an object"})
+                continue
+
+            dob = parse_date(item.get('dob'))
+            if dob is None or is_blank(item.get('name')) \
+                    or is_blank(item.get('full_name')):
+                errors.append({
+                    "index": index,
+                    "message": "name, full_name and dob (YYYY/MM/DD) "
+                               "are required"
+                })
+                continue
+
+            rows.append({
+                'name': item['name'],
+                'full_name': item['full_name'],
+                'dob': dob
+            })
+
+        if errors:
+            return bulk_errors(errors)
+
+        try:
+            Author.insert_many(rows)
+            cache.invalidate('authors')
+
+            return jsonify({
+                "success": True,
+                "created": len(rows)
+            }), 200
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    @app.route('/books/bulk', methods=['POST'])
+    @requires_auth("post:books")
+    def post_books_bulk(payload):
+        items = get_bulk_items('books')
+
+        author_ids = {item.get('author_id') for item in items
+                      if isinstance(item, dict)
+                      and type(item.get('author_id')) is int}
+        existing_author_ids = Author.existing_ids(author_ids)
+
+        rows = []
+        errors = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors.append({"index": index, "message": "Not an object"})
+                continue
+
+            release_date = parse_date(item.get('release_date'))
+            if release_date is None or is_blank(item.get('title')):
+                errors.append({
+                    "index": index,
+                    "message": "title and release_date (YYYY/MM/DD) "
+                               "are required"
+                })
+                continue
+
+            if type(item.get('author_id')) is not int \
+                    or item['author_id'] not in existing_author_ids:
+                errors.append({
+                    "index": index,
+                    "message": "author_id does not exist"
+                })
+                continue
+
+            rows.append({
+                'title': item['title'],
+                'description': item.get('description'),
+                'release_date': release_date,
+                'author_id': item['author_id']
+            })
+
+        if errors:
+            return bulk_errors(errors)
+
+        try:
+            Book.insert_many(rows)
+            cache.invalidate('books', *{'author:%d' % row['author_id']
+                                        for row in rows})
+
+            return jsonify({
+                "success": True,
+                "created": len(rows)
+            }), 200
+        except Exception as e:
+            print(e)
+            abort(422)
+
     @app.route('/books/<int:book_id>', methods=['PATCH'])
     @requires_auth("patch:books")
     def edit_book(payload, book_id):
@@ -189,6 +536,7 @@ def create_app(test_config=None):
                 return abort(400)
 
         try:
+            old_author_id = book.author_id
 
             if title is not None:
                 book.title = title
@@ -197,12 +545,15 @@ def create_app(test_config=None):
                 book.description = description
 
             if release_date is not None:
-                book.release_date = release_date
+                book.release_date = parse_date(release_date)
 
             if author_id is not None:
                 book.author_id = author_id
 
             book.update()
+            cache.invalidate('books', 'book:%d' % book_id,
+                             'author:%s' % old_author_id,
+                             'author:%s' % book.author_id)
 
             return jsonify({
                 "success": True,
@@ -239,9 +590,13 @@ def create_app(test_config=None):
                 author.full_name = full_name
 
             if dob is not None:
-                author.dob = dob
+                author.dob = parse_date(dob)
 
             author.update()
+            cache.invalidate('authors', 'author:%d' % author_id)
+
+            if name is not None:
+                cache.invalidate('books', 'book-details')
 
             return jsonify({
                 "success": True,
@@ -251,6 +606,130 @@ def create_app(test_config=None):
             print(e)
             abort(422)
 
+    @app.route('/books/bulk', methods=['PATCH'])
+    @requires_auth("patch:books")
+    def edit_books_bulk(payload):
+        body = request.get_json(silent=True)
+        book_ids = get_bulk_ids(body)
+
+        values = {}
+
+        if body.get('title') is not None:
+            values['title'] = body['title']
+
+        if body.get('description') is not None:
+            values['description'] = body['description']
+
+        if body.get('release_date') is not None:
+            values['release_date'] = parse_date(body['release_date'])
+
+            if values['release_date'] is None:
+                return abort(400)
+
+        if body.get('author_id') is not None:
+            values['author_id'] = body['author_id']
+
+            if type(body['author_id']) is not int \
+                    or not Author.existing_ids([body['author_id']]):
+                return abort(400)
+
+        if not values:
+            return abort(400)
+
+        try:
+            affected = Book.update_many(book_ids, values)
+            cache.invalidate('books', 'author-details',
+                             *['book:%d' % book_id for book_id in affected])
+
+            return jsonify({
+                "success": True,
+                "books": affected,
+                "missing": sorted(book_ids.difference(affected))
+            }), 200
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    @app.route('/authors/bulk', methods=['PATCH'])
+    @requires_auth("patch:authors")
+    def edit_authors_bulk(payload):
+        body = request.get_json(silent=True)
+        author_ids = get_bulk_ids(body)
+
+        values = {}
+
+        if body.get('name') is not None:
+            values['name'] = body['name']
+
+        if body.get('full_name') is not None:
+            values['full_name'] = body['full_name']
+
+        if body.get('dob') is not None:
+            values['dob'] = parse_date(body['dob'])
+
+            if values['dob'] is None:
+                return abort(400)
+
+        if not values:
+            return abort(400)
+
+        try:
+            affected = Author.update_many(author_ids, values)
+            cache.invalidate('authors',
+                             *['author:%d' % author_id
+                               for author_id in affected])
+
+            if 'name' in values:
+                cache.invalidate('books', 'book-details')
+
+            return jsonify({
+                "success": True,
+                "authors": affected,
+                "missing": sorted(author_ids.difference(affected))
+            }), 200
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    @app.route('/books/bulk', methods=['DELETE'])
+    @requires_auth("delete:books")
+    def delete_books_bulk(payload):
+        book_ids = get_bulk_ids(request.get_json(silent=True))
+
+        try:
+            affected = Book.delete_many(book_ids)
+            cache.invalidate('books', 'author-details',
+                             *['book:%d' % book_id for book_id in affected])
+
+            return jsonify({
+                "success": True,
+                "books": affected,
+                "missing": sorted(book_ids.difference(affected))
+            }), 200
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    @app.route('/authors/bulk', methods=['DELETE'])
+    @requires_auth("delete:authors")
+    def delete_authors_bulk(payload):
+        author_ids = get_bulk_ids(request.get_json(silent=True))
+
+        try:
+            affected = Author.delete_many(author_ids)
+            cache.invalidate('authors', 'books', 'book-details',
+                             *['author:%d' % author_id
+                               for author_id in affected])
+
+            return jsonify({
+                "success": True,
+                "authors": affected,
+                "missing": sorted(author_ids.difference(affected))
+            }), 200
+        except Exception as e:
+            print(e)
+            abort(422)
+
     @app.route('/authors/<int:author_id>', methods=['DELETE'])
     @requires_auth("delete:authors")
     def delete_author(payload, author_id):
@@ -261,6 +740,8 @@ def create_app(test_config=None):
 
         try:
             author.delete()
+            cache.invalidate('authors', 'author:%d' % author_id, 'books',
+                             'book-details')
             return jsonify({
                 "success": True,
                 "authors": [author_id]
@@ -278,7 +759,10 @@ def create_app(test_config=None):
             abort(404)
 
         try:
+            author_id = book.author_id
             book.delete()
+            cache.invalidate('books', 'book:%d' % book_id,
+                             'author:%s' % author_id)
             return jsonify({
                 "success": True,
                 "books": [book_id]
@@ -327,6 +811,17 @@ def create_app(test_config=None):
             "message": "Internal Server Error"
         }), 500
 
+    @app.errorhandler(FieldsetError)
+    @app.errorhandler(FilterError)
+    @app.errorhandler(SearchError)
+    @app.errorhandler(PaginationError)
+    def invalid_query(error):
+        return jsonify({
+            "success": False,
+            "error": 400,
+            "message": "Bad Request"
+        }), 400
+
     @app.errorhandler(AuthError)
     def auth_error(error):
         print(error)
@@ -0,0 +1,181 @@
+"""ASGI serving mode: the same Flask routes on an event loop.
+
+    uvicorn --factory asgi:create_asgi_app --workers 4
+
+Every request runs the unchanged Flask app inside its own greenlet via
+SQLAlchemy's ``greenlet_spawn``, with the engines switched to async
+drivers (asyncpg, aiosqlite). Whenever a query waits on the database, or
+a JWKS fetch waits on the network, the greenlet yields to the event loop
+and other requests proceed, so one worker serves many requests at once
+instead of one. Routes, auth, caching and errors behave exactly as under
+gunicorn, because they are the same code.
+
+Only I/O that goes through the async engines or the key store yields.
+The ``redis`` response cache backend is synchronous and would block the
+loop, so use ``CACHE_TYPE=local`` or ``none`` in this mode.
+"""
+import io
+import os
+import sys
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.util import await_only, greenlet_spawn
+
+from app import create_app
+from auth import auth
+from auth.jwks import AsyncJWKSKeyStore
+from database.models import database_path
+
+# Async driver used for each backend when the URL does not name one.
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite'
+}
+
+
+def async_database_url(url):
+    """Return ``url`` with an async driver, e.g. ``postgresql+asyncpg``."""
+    url = make_url(url)
+    if url.get_dialect().is_async:
+        return str(url)
+
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError('No async driver known for %s' % backend)
+    return str(url.set(drivername='%s+%s' % (backend,
+                                             ASYNC_DRIVERS[backend])))
+
+
+def build_environ(scope, body):
+    """Translate an ASGI HTTP scope into a WSGI environ."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8')
+        .decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        # The body is already buffered, which also covers chunked uploads
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name not in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value \
+                if key in environ else value
+    return environ
+
+
+class GreenletBridge:
+    """Serve a WSGI app over ASGI, one greenlet per request."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope %s' % scope['type'])
+
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        await greenlet_spawn(self._serve,
+                             build_environ(scope, b''.join(chunks)), send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _serve(self, environ, send):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1'))
+                for name, value in headers]
+
+        def start():
+            await_only(send({
+                'type': 'http.response.start',
+                'status': response['status'],
+                'headers': response['headers']
+            }))
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    start()
+                    started = True
+                await_only(send({'type': 'http.response.body',
+                                 'body': chunk, 'more_body': True}))
+
+            if not started:
+                start()
+            await_only(send({'type': 'http.response.body', 'body': b''}))
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+def create_asgi_app(test_config=None):
+    """Build the Flask app on async drivers and wrap it for ASGI."""
+    config = dict(test_config or {})
+    config['SQLALCHEMY_DATABASE_URI'] = async_database_url(
+        config.get('SQLALCHEMY_DATABASE_URI', database_path))
+
+    replicas = config.get('SQLALCHEMY_REPLICA_URLS')
+    if replicas is None:
+        replicas = [url.strip() for url in os.environ.get(
+            'DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    config['SQLALCHEMY_REPLICA_URLS'] = [async_database_url(url)
+                                         for url in replicas]
+
+    store = auth.jwks_store
+    if not isinstance(store, AsyncJWKSKeyStore):
+        store = AsyncJWKSKeyStore(
+            store.url, algorithm=store.algorithm, ttl=store.ttl,
+            min_refresh_interval=store.min_refresh_interval,
+            timeout=store.timeout)
+        store.add_listener(auth.token_cache.evict_kids)
+
+    # Kept on the app: swapping auth.jwks_store would hand the async store
+    # to any sync app in the same process.
+    flask_app = create_app(config)
+    flask_app.extensions['jwks_store'] = store
+    return GreenletBridge(flask_app)
@@ -1,13 +1,38 @@
-import json
-from flask import request, _request_ctx_stack
+from collections import namedtuple
+from flask import request, g, _request_ctx_stack, current_app, \
+    has_app_context
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 import os
+import time
+
+from auth.jwks import JWKSKeyStore, JWKSUnavailableError
+from auth.token_cache import VerifiedTokenCache
+from metrics.metrics import JWT_SECONDS
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = [os.environ['ALGORITHMS']]
 API_AUDIENCE = os.environ['API_AUDIENCE']
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+jwks_store = JWKSKeyStore(
+    JWKS_URL,
+    algorithm=ALGORITHMS[0],
+    ttl=int(os.environ.get('JWKS_CACHE_TTL', 600)),
+    min_refresh_interval=int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+)
+
+token_cache = VerifiedTokenCache(
+    maxsize=int(os.environ.get('TOKEN_CACHE_SIZE', 1024)),
+    max_age=int(os.environ.get('TOKEN_CACHE_MAX_AGE', 600))
+)
+jwks_store.add_listener(token_cache.evict_kids)
+
+# A verified token together with its permissions, precomputed once so the
+# per-request check is a set lookup. ``permissions`` is None when the
+# token carries no permissions claim.
+Principal = namedtuple('Principal', ['payload', 'permissions', 'kid'])
 
 
 class AuthError(Exception):
@@ -47,41 +72,67 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
+def key_store():
+    """The key store of the current app, or the process-wide one.
 
-    if permission not in payload['permissions']:
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission not found.'
-        }, 403)
-    return True
+    The ASGI mode gives its app an async store in ``app.extensions`` so a
+    sync app in the same process keeps the blocking one.
+    """
+    if has_app_context():
+        return current_app.extensions.get('jwks_store', jwks_store)
+    return jwks_store
+
+
+def authenticate(token):
+    started = time.perf_counter()
+    principal = token_cache.get(token)
+    if principal is not None:
+        JWT_SECONDS.observe(time.perf_counter() - started, ('cached',))
+        return principal
+
+    try:
+        payload, kid = decode_jwt(token)
+    except AuthError:
+        JWT_SECONDS.observe(time.perf_counter() - started, ('rejected',))
+        raise
+
+    permissions = payload.get('permissions')
+    if permissions is not None:
+        permissions = frozenset(permissions)
+
+    principal = Principal(payload, permissions, kid)
+    token_cache.put(token, principal, kid, payload.get('exp'))
+    JWT_SECONDS.observe(time.perf_counter() - started, ('verified',))
+    return principal
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    return authenticate(token).payload
+
+
+def decode_jwt(token):
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    try:
+        rsa_key = key_store().get_key(unverified_header['kid'])
+    except JWKSUnavailableError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch signing keys.'
+        }, 503)
+
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -92,7 +143,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
-            return payload
+            return payload, unverified_header['kid']
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -120,13 +171,29 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+def check_principal(permission, principal):
+    if principal.permissions is None:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Permissions not included in JWT.'
+        }, 400)
+
+    if permission not in principal.permissions:
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found.'
+        }, 403)
+    return True
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            principal = authenticate(token)
+            check_principal(permission, principal)
+            g.principal = principal
+            return f(principal.payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from urllib.request import urlopen
+
+from jose import jwk
+from sqlalchemy.util import await_only
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSUnavailableError(Exception):
+    pass
+
+
+class JWKSKeyStore:
+    """In-process cache of the signing keys published in a JWKS document.
+
+    Keys are parsed once per fetch and kept ready per ``kid``. The document
+    is refetched when it is older than ``ttl`` seconds, or when a token
+    names a ``kid`` we have not seen, but never more often than once per
+    ``min_refresh_interval`` seconds so forged kids cannot cause a fetch
+    storm. If a refresh fails the previously fetched keys keep being served.
+
+    ``url`` may be any URL understood by ``urlopen``, including ``file://``
+    URLs pointing at a local JWKS stand-in.
+    """
+
+    def __init__(self, url, algorithm='RS256', ttl=600,
+                 min_refresh_interval=30, timeout=5, clock=time.monotonic):
+        self.url = url
+        self.algorithm = algorithm
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.clock = clock
+
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._listeners = []
+
+        self.fetch_count = 0
+        self.fetch_failures = 0
+
+    def get_key(self, kid):
+        """Return the parsed key for ``kid`` or None if it is unknown."""
+        now = self.clock()
+
+        if self._fetched_at is None or now - self._fetched_at >= self.ttl:
+            self._try_refresh(now)
+        elif kid not in self._keys:
+            self._try_refresh(now)
+
+        if not self._keys and self._fetched_at is None:
+            raise JWKSUnavailableError(
+                'Unable to fetch signing keys from %s' % self.url)
+
+        return self._keys.get(kid)
+
+    def kids(self):
+        return frozenset(self._keys)
+
+    def add_listener(self, callback):
+        """Call ``callback(removed_kids)`` when a refresh drops keys."""
+        self._listeners.append(callback)
+
+    def refresh(self):
+        """Fetch the JWKS document now, regardless of TTL or rate limit."""
+        with self._lock:
+            self._refresh(self.clock())
+
+    def clear(self):
+        with self._lock:
+            removed = set(self._keys)
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+        self._notify(removed)
+
+    def _try_refresh(self, now):
+        # Before the first successful fetch there is nothing to serve, so
+        # callers queue on the lock and see the result of the fetch in
+        # flight instead of failing straight away.
+        initial = self._fetched_at is None
+        if not initial and self._last_attempt is not None \
+                and now - self._last_attempt < self.min_refresh_interval:
+            return
+
+        # Only one thread refreshes; the others keep using the current keys.
+        if not self._lock.acquire(blocking=initial):
+            return
+
+        try:
+            if self._last_attempt is not None \
+                    and now - self._last_attempt < self.min_refresh_interval:
+                return
+            self._refresh(now)
+        except Exception as e:
+            self.fetch_failures += 1
+            logger.warning('JWKS refresh from %s failed: %s', self.url, e)
+        finally:
+            self._lock.release()
+
+    def _refresh(self, now):
+        self._last_attempt = now
+        self.fetch_count += 1
+
+        keys = self._parse(self._fetch_document())
+        removed = set(self._keys) - set(keys)
+
+        self._keys = keys
+        self._fetched_at = now
+        self._notify(removed)
+
+    def _fetch_document(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def _notify(self, removed):
+        if not removed:
+            return
+        for callback in self._listeners:
+            callback(removed)
+
+    def _parse(self, document):
+        keys = {}
+        for key in document.get('keys', []):
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            if key.get('use', 'sig') != 'sig':
+                continue
+
+            keys[key['kid']] = jwk.construct({
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }, key.get('alg', self.algorithm))
+        return keys
+
+
+class GreenletLock:
+    """``threading.Lock`` look-alike for code running in ``greenlet_spawn``.
+
+    Requests served by the ASGI bridge share one thread, so a blocking
+    ``threading.Lock`` held across an await would stall the event loop.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    def acquire(self, blocking=True):
+        if not blocking and self._lock.locked():
+            return False
+        await_only(self._lock.acquire())
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class AsyncJWKSKeyStore(JWKSKeyStore):
+    """Key store for the ASGI mode: fetches never block the event loop.
+
+    The document is downloaded in the default executor while the request
+    greenlet yields, and concurrent requests wait on a :class:`GreenletLock`.
+    Must be used from code running under ``greenlet_spawn``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = GreenletLock()
+
+    def _fetch_document(self):
+        loop = asyncio.get_running_loop()
+        return await_only(
+            loop.run_in_executor(None, super()._fetch_document))
@@ -0,0 +1,82 @@
+"""Offline stand-ins for Auth0, used by the tests and benchmarks.
+
+``LocalSigner`` owns a locally generated RSA key, publishes its public half
+as a JWKS document on disk and signs access tokens the same way Auth0 does.
+"""
+import json
+import os
+import tempfile
+import time
+import uuid
+
+import rsa
+from jose import jwk, jwt
+
+
+class LocalSigner:
+
+    def __init__(self, domain, audience, kid=None, bits=1024,
+                 jwks_path=None):
+        self.domain = domain
+        self.audience = audience
+        self.keys = {}
+
+        if jwks_path is None:
+            fd, jwks_path = tempfile.mkstemp(suffix='.json')
+            os.close(fd)
+        self.jwks_path = jwks_path
+        self.bits = bits
+
+        self.kid = None
+        self.rotate(kid)
+
+    @property
+    def jwks_url(self):
+        return 'file://' + os.path.abspath(self.jwks_path)
+
+    def rotate(self, kid=None, keep_old=False):
+        """Switch to a fresh signing key and republish the JWKS document."""
+        if not keep_old:
+            self.keys = {}
+        self.kid = kid or uuid.uuid4().hex
+        _, private_key = rsa.newkeys(self.bits)
+        self.keys[self.kid] = private_key.save_pkcs1().decode()
+        self.publish()
+        return self.kid
+
+    def publish(self):
+        keys = []
+        for kid, pem in self.keys.items():
+            public = jwk.construct(pem, 'RS256').public_key().to_dict()
+            keys.append({
+                'kty': public['kty'],
+                'kid': kid,
+                'use': 'sig',
+                'alg': 'RS256',
+                'n': public['n'],
+                'e': public['e']
+            })
+
+        with open(self.jwks_path, 'w') as f:
+            json.dump({'keys': keys}, f)
+
+    def token(self, permissions=(), expires_in=3600, kid=None, **claims):
+        kid = kid or self.kid
+        now = int(time.time())
+        payload = {
+            'iss': 'https://' + self.domain + '/',
+            'sub': 'local-signer@clients',
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in
+        }
+        if permissions is not None:
+            payload['permissions'] = list(permissions)
+        payload.update(claims)
+
+        return jwt.encode(payload, self.keys[kid], algorithm='RS256',
+                          headers={'kid': kid})
+
+    def close(self):
+        if os.path.exists(self.jwks_path):
+            os.remove(self.jwks_path)
@@ -0,0 +1,98 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of already verified bearer tokens.
+
+    Entries are keyed by a SHA-256 of the raw token and hold whatever was
+    derived from the verified token until its ``exp`` or ``max_age``
+    seconds after it was verified, whichever comes first. ``evict_kids``
+    drops every entry verified with one of the given signing keys, so a
+    key rotated out of the JWKS document stops being trusted straight away.
+    """
+
+    def __init__(self, maxsize=1024, max_age=600, clock=time.time):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.clock = clock
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        if self.maxsize <= 0:
+            return None
+
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, kid, expires_at = entry
+            if self.clock() >= expires_at:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, token, value, kid, exp=None):
+        if self.maxsize <= 0:
+            return
+
+        expires_at = self.clock() + self.max_age
+        if exp is not None:
+            expires_at = min(expires_at, exp)
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (value, kid, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def evict_kids(self, kids):
+        kids = set(kids)
+        if not kids:
+            return
+
+        with self._lock:
+            stale = [key for key, (_, kid, _) in self._entries.items()
+                     if kid in kids]
+            for key in stale:
+                del self._entries[key]
+            self.evictions += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
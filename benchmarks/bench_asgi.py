@@ -0,0 +1,178 @@
+"""Load test of the sync (gunicorn) and async (uvicorn) deployments.
+
+Seeds a SQLite catalog, starts each server with the same number of
+worker processes, and drives ``GET /books`` with ``concurrency`` clients
+for ``duration`` seconds, reporting requests/sec and latency percentiles.
+Every SQL statement is delayed by ``latency_ms`` to stand in for the
+network round trip to Postgres, which is what the async mode overlaps.
+
+    python -m benchmarks.bench_asgi [concurrency] [duration] [latency_ms]
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bookstore.test')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bookstore-test')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.util import await_only
+
+from auth import auth
+from auth.testing import LocalSigner
+
+WORKERS = 2
+PATH = '/books?limit=20'
+
+
+def add_latency(is_async):
+    seconds = float(os.environ.get('BENCH_DB_LATENCY_MS', 0)) / 1000.0
+    if not seconds:
+        return
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def network_round_trip(*args):
+        if is_async:
+            await_only(asyncio.sleep(seconds))
+        else:
+            time.sleep(seconds)
+
+
+def sync_app():
+    """gunicorn entry point: the current deployment plus latency."""
+    add_latency(is_async=False)
+    from app import create_app
+    return create_app({'CACHE_TYPE': 'none'})
+
+
+def async_app():
+    """uvicorn entry point: the ASGI mode plus latency."""
+    add_latency(is_async=True)
+    from asgi import create_asgi_app
+    return create_asgi_app({'CACHE_TYPE': 'none'})
+
+
+COMMANDS = {
+    'sync': ['gunicorn', '-w', str(WORKERS), '-b', '127.0.0.1:{port}',
+             'benchmarks.bench_asgi:sync_app()'],
+    'async': ['uvicorn', '--factory', 'benchmarks.bench_asgi:async_app',
+              '--workers', str(WORKERS), '--port', '{port}',
+              '--log-level', 'warning']
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def get(port, headers):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('GET %s HTTP/1.1\r\nHost: localhost\r\n%s'
+                  'Connection: close\r\n\r\n' % (PATH, headers)).encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+async def load(port, token, concurrency, duration):
+    headers = 'Authorization: Bearer %s\r\n' % token
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                status = await get(port, headers)
+            except OSError:
+                status = None
+            if status == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, errors
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server on port %d did not start' % port)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(mode, env, token, concurrency, duration):
+    port = free_port()
+    command = [part.format(port=port) for part in COMMANDS[mode]]
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port)
+        asyncio.run(load(port, token, 2, 1))
+        latencies, errors = asyncio.run(
+            load(port, token, concurrency, duration))
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'mode': mode,
+        'requests_per_second': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'errors': errors
+    }
+
+
+def run(concurrency=32, duration=10, latency_ms=20, rows=10000):
+    from benchmarks.bench_export import seed
+
+    signer = LocalSigner(auth.AUTH0_DOMAIN, auth.API_AUDIENCE)
+    token = signer.token(['get:books'])
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.db')
+            seed(path, rows)
+            env = dict(os.environ, DATABASE_URL='sqlite:///' + path,
+                       JWKS_URL=signer.jwks_url,
+                       BENCH_DB_LATENCY_MS=str(latency_ms))
+
+            return [measure(mode, env, token, concurrency, duration)
+                    for mode in ('sync', 'async')]
+    finally:
+        signer.close()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    concurrency = int(args[0]) if len(args) > 0 else 32
+    duration = float(args[1]) if len(args) > 1 else 10
+    latency_ms = float(args[2]) if len(args) > 2 else 20
+
+    print('%d workers, %d clients, %gs, %gms per query' % (
+        WORKERS, concurrency, duration, latency_ms))
+    for result in run(concurrency, duration, latency_ms):
+        print('%-6s %8.1f req/s  p50 %7.1f ms  p99 %7.1f ms  %d errors' % (
+            result['mode'], result['requests_per_second'],
+            result['p50_ms'], result['p99_ms'], result['errors']))
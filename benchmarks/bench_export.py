@@ -0,0 +1,118 @@
+"""Peak worker memory of the NDJSON export versus a materialized listing.
+
+Seeds a SQLite file with ``rows`` books, then fetches ``/books/export``
+and ``/books?all=true`` each in a fresh process and records peak RSS.
+
+    python -m benchmarks.bench_export [rows]
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bookstore.test')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bookstore-test')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import create_app
+from auth import auth
+from auth.jwks import JWKSKeyStore
+from auth.testing import LocalSigner
+from database.models import db, Book, Author
+
+SEED_CHUNK = 10000
+MODES = {
+    'export': '/books/export',
+    'list': '/books?all=true'
+}
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def seed(path, rows, authors=1000):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path})
+    with app.app_context():
+        db.create_all()
+        # One transaction, so every row shares one change revision
+        with db.engine.begin() as connection:
+            connection.execute(Author.__table__.insert(), [
+                {'name': 'author%d' % i, 'full_name': 'Author %d' % i,
+                 'dob': date(1970, 1, 1)}
+                for i in range(authors)
+            ])
+
+            for start in range(0, rows, SEED_CHUNK):
+                connection.execute(Book.__table__.insert(), [
+                    {'title': 'book%d' % i,
+                     'description': 'description %d' % i,
+                     'release_date': date(2020, 1, 1),
+                     'author_id': i % authors + 1}
+                    for i in range(start, min(start + SEED_CHUNK, rows))
+                ])
+
+
+def measure(path, mode):
+    signer = LocalSigner(auth.AUTH0_DOMAIN, auth.API_AUDIENCE)
+    auth.jwks_store = JWKSKeyStore(signer.jwks_url)
+    headers = {'Authorization': 'Bearer ' + signer.token(
+        ['get:books', 'get:all'])}
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path})
+    client = app.test_client()
+    assert client.get('/books?limit=1', headers=headers).status_code == 200
+    baseline = peak_rss_mb()
+
+    started = time.perf_counter()
+    res = client.get(MODES[mode], headers=headers, buffered=False)
+    # An error body would make the memory comparison meaningless
+    assert res.status_code == 200, '%s returned %s' % (MODES[mode],
+                                                       res.status)
+    size = 0
+    for chunk in res.response:
+        size += len(chunk)
+    res.close()
+    elapsed = time.perf_counter() - started
+
+    signer.close()
+    return {
+        'mode': mode,
+        'seconds': round(elapsed, 2),
+        'bytes': size,
+        'baseline_rss_mb': round(baseline, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+
+def run(rows):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        seed(path, rows)
+        results = []
+        for mode in MODES:
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.bench_export',
+                '--measure', path, mode
+            ])
+            results.append(json.loads(output.decode().splitlines()[-1]))
+        return results
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        print(json.dumps(measure(sys.argv[2], sys.argv[3])))
+    else:
+        rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+        for result in run(rows):
+            print('%(mode)-7s %(seconds)7.2fs %(bytes)12d bytes  '
+                  'rss %(baseline_rss_mb)7.1f MB -> %(peak_rss_mb)7.1f MB'
+                  % result)
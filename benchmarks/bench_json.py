@@ -0,0 +1,67 @@
+"""Serialization benchmark for a 10k-book response.
+
+Times ``jsonify`` of 10,000 books in the ``long()`` shape with Flask's
+default provider, then with ``FastJSONProvider`` on the stdlib encoder
+and on orjson, for both date formats.
+
+    python -m benchmarks.bench_json [books] [iterations]
+"""
+import sys
+import timeit
+from datetime import date
+
+from flask import Flask, jsonify
+from flask.json.provider import DefaultJSONProvider
+
+from serialization.serialization import FastJSONProvider, orjson
+
+
+def make_books(count):
+    return [{
+        'id': i,
+        'title': 'Book %d' % i,
+        'description': 'Description of book %d' % i,
+        'release_date': date(2000 + i % 20, i % 12 + 1, i % 28 + 1),
+        'author': 'Author %d' % (i % 100)
+    } for i in range(count)]
+
+
+def measure(payload, iterations):
+    jsonify(payload)
+    seconds = timeit.timeit(lambda: jsonify(payload), number=iterations)
+    return seconds / iterations * 1e3
+
+
+def run(count=10000, iterations=20):
+    app = Flask(__name__)
+    payload = {'success': True, 'books': make_books(count)}
+
+    variants = [('stdlib', False)]
+    if orjson is not None:
+        variants.append(('orjson', True))
+
+    results = {}
+    with app.app_context():
+        app.json = DefaultJSONProvider(app)
+        results['flask/http'] = measure(payload, iterations)
+
+        provider = app.json = FastJSONProvider(app)
+        for date_format in ('http', 'iso'):
+            for name, use_orjson in variants:
+                provider.use_orjson = use_orjson
+                provider.date_format = date_format
+                results['%s/%s' % (name, date_format)] = \
+                    measure(payload, iterations)
+    return results
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    results = run(count, iterations)
+
+    for name, msec in results.items():
+        print('%-12s %8.2f ms/response' % (name, msec))
+    # Same output as the default provider, so compare the http variants
+    fast = results.get('orjson/http', results['stdlib/http'])
+    print('speedup      %8.1fx' % (results['flask/http'] / fast))
@@ -0,0 +1,66 @@
+"""Per-request cost of the Prometheus metrics.
+
+Serves ``GET /books?limit=20`` through the test client with
+``METRICS_ENABLED`` off and on against the same SQLite catalog. The
+engine events are process wide once installed, so the disabled app is
+measured first.
+
+    python -m benchmarks.bench_metrics [iterations]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bookstore.test')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bookstore-test')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import create_app
+from auth import auth
+from auth.jwks import JWKSKeyStore
+from auth.testing import LocalSigner
+from benchmarks.bench_export import seed
+
+
+def measure(path, headers, enabled, iterations):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+                      'CACHE_TYPE': 'none', 'METRICS_ENABLED': enabled})
+    client = app.test_client()
+
+    def request():
+        assert client.get('/books?limit=20', headers=headers).status_code \
+            == 200
+
+    request()
+    return timeit.timeit(request, number=iterations) / iterations * 1e6
+
+
+def run(iterations=2000, rows=1000):
+    signer = LocalSigner(auth.AUTH0_DOMAIN, auth.API_AUDIENCE)
+    headers = {'Authorization': 'Bearer ' + signer.token(['get:books'])}
+    auth.jwks_store = JWKSKeyStore(signer.jwks_url)
+    auth.jwks_store.add_listener(auth.token_cache.evict_kids)
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.db')
+            seed(path, rows)
+            return {
+                'disabled': measure(path, headers, False, iterations),
+                'enabled': measure(path, headers, True, iterations)
+            }
+    finally:
+        signer.close()
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    results = run(iterations)
+
+    for name, usec in results.items():
+        print('%-9s %10.1f us/request' % (name, usec))
+    print('overhead  %10.1f us/request (%.1f%%)' % (
+        results['enabled'] - results['disabled'],
+        (results['enabled'] / results['disabled'] - 1) * 100))
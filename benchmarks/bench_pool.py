@@ -0,0 +1,83 @@
+"""Saturate the connection pool and report how it behaves.
+
+``threads`` workers each run ``requests`` queries that hold a connection
+for ``hold`` seconds, against pools of different size/overflow. With
+more workers than ``pool_size + max_overflow`` the extra ones wait, and
+give up after ``pool_timeout``; the checked-out peak never exceeds the
+configured capacity.
+
+    python -m benchmarks.bench_pool [threads] [requests] [hold]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, exc, text
+
+from database.pool import queue_pool_options, pool_stats
+
+CONFIGS = [
+    {'pool_size': 2, 'max_overflow': 0, 'pool_timeout': 0.5},
+    {'pool_size': 2, 'max_overflow': 4, 'pool_timeout': 0.5},
+    {'pool_size': 8, 'max_overflow': 8, 'pool_timeout': 5},
+]
+
+
+def run_config(url, config, threads, requests, hold):
+    engine = create_engine(url, connect_args={'check_same_thread': False},
+                           **queue_pool_options(pool_pre_ping=False, **config))
+    peak = [0]
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(requests):
+            try:
+                with engine.connect() as connection:
+                    with lock:
+                        peak[0] = max(peak[0],
+                                      engine.pool.checkedout())
+                    connection.execute(text('SELECT 1'))
+                    time.sleep(hold)
+            except exc.TimeoutError:
+                pass
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    stats = pool_stats(engine)
+    engine.dispose()
+    return dict(config, peak_checked_out=peak[0],
+                queries_per_second=round(stats['checkouts'] / elapsed, 1),
+                **{key: stats[key] for key in (
+                    'checkouts', 'timeouts', 'wait_seconds_max')})
+
+
+def run(threads=16, requests=10, hold=0.05):
+    with tempfile.TemporaryDirectory() as directory:
+        url = 'sqlite:///' + os.path.join(directory, 'pool.db')
+        return [run_config(url, config, threads, requests, hold)
+                for config in CONFIGS]
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    threads = int(args[0]) if len(args) > 0 else 16
+    requests = int(args[1]) if len(args) > 1 else 10
+    hold = float(args[2]) if len(args) > 2 else 0.05
+
+    print('%4s %8s %7s %5s %9s %8s %8s %9s' % (
+        'size', 'overflow', 'timeout', 'peak', 'checkouts', 'timeouts',
+        'wait max', 'queries/s'))
+    for result in run(threads, requests, hold):
+        print('%4d %8d %7.1f %5d %9d %8d %8.3f %9.1f' % (
+            result['pool_size'], result['max_overflow'],
+            result['pool_timeout'], result['peak_checked_out'],
+            result['checkouts'], result['timeouts'],
+            result['wait_seconds_max'], result['queries_per_second']))
@@ -0,0 +1,77 @@
+"""CPU time and allocations of a listing built from rows versus ORM objects.
+
+Seeds a SQLite file with ``rows`` books, then builds the ``short()``
+listing of every book through ORM instances (``joinedload`` +
+``short()``) and through the column read path used by ``GET /books``.
+Both are timed under tracemalloc, so compare the ratio, not the seconds.
+
+    python -m benchmarks.bench_rows [rows]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bookstore.test')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bookstore-test')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy.orm import joinedload
+
+from app import create_app
+from benchmarks.bench_export import seed
+from database.fieldsets import BOOK_FIELDSET
+from database.models import db, Book
+
+
+def orm_listing():
+    books = Book.query.options(joinedload(Book.author)).order_by(Book.id)
+    return [book.short() for book in books]
+
+
+def row_listing():
+    selection = BOOK_FIELDSET.select({})
+    return selection.render(selection.query().order_by(Book.id).all())
+
+
+def measure(app, listing):
+    with app.app_context():
+        listing()
+        db.session.remove()
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        items = listing()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        db.session.remove()
+
+    return {'seconds': elapsed, 'peak_mb': peak / 1024.0 / 1024.0,
+            'items': len(items)}
+
+
+def run(rows=100000):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'catalog.db')
+        seed(path, rows)
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+                          'CACHE_TYPE': 'none'})
+
+        return {
+            'orm': measure(app, orm_listing),
+            'rows': measure(app, row_listing)
+        }
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    results = run(rows)
+
+    for name, result in results.items():
+        print('%-5s %8.3f s %10.1f MB peak  %d items' % (
+            name, result['seconds'], result['peak_mb'], result['items']))
+    print('speedup %6.1fx' % (results['orm']['seconds'] /
+                              results['rows']['seconds']))
@@ -0,0 +1,449 @@
+"""Reproducible benchmark of every API route.
+
+Seeds a deterministic catalog into a fresh SQLite file (or an empty
+database given with ``--database``), signs one token carrying every
+permission with a local RSA key served as a ``file://`` JWKS, and sends
+``--requests`` requests to every route registered by ``create_app``
+through the test client. Reads run first against the seeded catalog,
+then writes, then deletes of rows inserted for that purpose.
+
+For each route the report has throughput, latency percentiles, SQL
+queries per request and the peak Python allocation of one request; the
+whole run adds the process peak RSS. Everything is written as JSON to
+``--output`` so runs from CI can be diffed.
+
+    python -m benchmarks.suite [--authors 10000] [--books 1000000]
+                               [--database postgresql://localhost/bench]
+                               [--requests 200] [--output results.json]
+
+The run fails if a route has no scenario, so new routes must add one.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, namedtuple
+from datetime import date, datetime, timedelta
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bookstore.test')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bookstore-test')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import flask
+import sqlalchemy
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine, make_url
+
+from app import create_app
+from auth import auth
+from auth.jwks import JWKSKeyStore
+from auth.testing import LocalSigner
+from database.models import db, Author, Book, bump_revision
+
+SEED_CHUNK = 10000
+BULK_SIZE = 100
+ALL_PERMISSIONS = [
+    'get:books', 'get:authors', 'get:books_by_author', 'get:books_detail',
+    'get:authors_detail', 'post:books', 'post:authors', 'patch:books',
+    'patch:authors', 'delete:books', 'delete:authors', 'get:stats',
+    'get:all'
+]
+
+# ``build(catalog, i)`` returns the path and JSON body of request ``i``.
+# ``requests`` caps the count for routes that read the whole catalog and
+# ``scratch`` is the number of disposable rows each request deletes.
+Scenario = namedtuple('Scenario', ['name', 'method', 'rule', 'build',
+                                   'requests', 'scratch'])
+
+
+def scenario(name, method, rule, build, requests=None, scratch=None):
+    return Scenario(name, method, rule, build, requests, scratch)
+
+
+def spread(i, count):
+    """Visit ids 1..count in a fixed order that does not follow the index."""
+    return i * 7919 % count + 1
+
+
+def get(path):
+    return lambda catalog, i: (path, None)
+
+
+def author_dates(i):
+    return date(1900, 1, 1) + timedelta(days=i % 36500)
+
+
+def book_dates(i):
+    return date(1950, 1, 1) + timedelta(days=i % 25000)
+
+
+SCENARIOS = [
+    scenario('status', 'GET', '/', get('/')),
+    scenario('cache stats', 'GET', '/cache/stats', get('/cache/stats')),
+    scenario('pool stats', 'GET', '/db/pool/stats', get('/db/pool/stats')),
+    scenario('replica stats', 'GET', '/db/replicas/stats',
+             get('/db/replicas/stats')),
+    scenario('metrics', 'GET', '/metrics', get('/metrics')),
+
+    scenario('list books', 'GET', '/books', get('/books')),
+    scenario('list books, 100 per page', 'GET', '/books',
+             get('/books?limit=100')),
+    scenario('list books, filtered and sorted', 'GET', '/books',
+             get('/books?released_after=2000/01/01&sort=release_date'
+                 '&order=desc&limit=50')),
+    scenario('list books, sparse with authors', 'GET', '/books',
+             get('/books?fields=id,title&include=author&limit=50')),
+    scenario('list books, deep page', 'GET', '/books',
+             lambda catalog, i: ('/books?limit=20&cursor=' +
+                                 catalog['deep_cursor'], None)),
+    scenario('batch get books', 'GET', '/books',
+             lambda catalog, i: ('/books?ids=' + ','.join(
+                 str(spread(i * 20 + j, catalog['books']))
+                 for j in range(20)), None)),
+    scenario('list authors', 'GET', '/authors', get('/authors')),
+    scenario('list authors, sorted by dob', 'GET', '/authors',
+             get('/authors?sort=dob&limit=50')),
+    scenario('book detail', 'GET', '/books/<int:book_id>',
+             lambda catalog, i: ('/books/%d' % spread(i, catalog['books']),
+                                 None)),
+    scenario('author detail', 'GET', '/authors/<int:author_id>',
+             lambda catalog, i: ('/authors/%d'
+                                 % spread(i, catalog['authors']), None)),
+    scenario('books by author', 'GET', '/books/author/<int:author_id>',
+             lambda catalog, i: ('/books/author/%d'
+                                 % spread(i, catalog['authors']), None)),
+    scenario('search books', 'GET', '/books/search',
+             lambda catalog, i: ('/books/search?q=book%d' % (i % 1000),
+                                 None)),
+    scenario('search authors', 'GET', '/authors/search',
+             lambda catalog, i: ('/authors/search?q=author%d' % (i % 100),
+                                 None)),
+    scenario('change feed', 'GET', '/changes', get('/changes?limit=100')),
+    scenario('export books', 'GET', '/books/export', get('/books/export'),
+             requests=3),
+    scenario('export authors', 'GET', '/authors/export',
+             get('/authors/export'), requests=3),
+
+    scenario('create author', 'POST', '/authors',
+             lambda catalog, i: ('/authors', {
+                 'name': 'bench%d' % i, 'full_name': 'Bench Author %d' % i,
+                 'dob': author_dates(i).strftime('%Y/%m/%d')})),
+    scenario('create book', 'POST', '/books',
+             lambda catalog, i: ('/books', {
+                 'title': 'bench%d' % i, 'description': 'benchmark',
+                 'release_date': book_dates(i).strftime('%Y/%m/%d'),
+                 'author_id': spread(i, catalog['authors'])})),
+    scenario('bulk create authors', 'POST', '/authors/bulk',
+             lambda catalog, i: ('/authors/bulk', {'authors': [
+                 {'name': 'bulk%d-%d' % (i, j), 'full_name': 'Bulk Author',
+                  'dob': author_dates(j).strftime('%Y/%m/%d')}
+                 for j in range(BULK_SIZE)]})),
+    scenario('bulk create books', 'POST', '/books/bulk',
+             lambda catalog, i: ('/books/bulk', {'books': [
+                 {'title': 'bulk%d-%d' % (i, j), 'description': 'benchmark',
+                  'release_date': book_dates(j).strftime('%Y/%m/%d'),
+                  'author_id': spread(i + j, catalog['authors'])}
+                 for j in range(BULK_SIZE)]})),
+    scenario('edit book', 'PATCH', '/books/<int:book_id>',
+             lambda catalog, i: ('/books/%d' % spread(i, catalog['books']),
+                                 {'description': 'edited %d' % i})),
+    scenario('edit author', 'PATCH', '/authors/<int:author_id>',
+             lambda catalog, i: ('/authors/%d'
+                                 % spread(i, catalog['authors']),
+                                 {'full_name': 'Edited Author %d' % i})),
+    scenario('bulk edit books', 'PATCH', '/books/bulk',
+             lambda catalog, i: ('/books/bulk', {
+                 'ids': [spread(i * BULK_SIZE + j, catalog['books'])
+                         for j in range(BULK_SIZE)],
+                 'description': 'bulk edited %d' % i})),
+    scenario('bulk edit authors', 'PATCH', '/authors/bulk',
+             lambda catalog, i: ('/authors/bulk', {
+                 'ids': [spread(i * BULK_SIZE + j, catalog['authors'])
+                         for j in range(BULK_SIZE)],
+                 'full_name': 'Bulk Edited %d' % i})),
+
+    scenario('delete book', 'DELETE', '/books/<int:book_id>',
+             lambda catalog, i: ('/books/%d' % catalog['scratch_books'][i],
+                                 None), scratch=1),
+    scenario('delete author', 'DELETE', '/authors/<int:author_id>',
+             lambda catalog, i: ('/authors/%d'
+                                 % catalog['scratch_authors'][i], None),
+             scratch=1),
+    scenario('bulk delete books', 'DELETE', '/books/bulk',
+             lambda catalog, i: ('/books/bulk', {
+                 'ids': catalog['scratch_books'][i * BULK_SIZE:
+                                                 (i + 1) * BULK_SIZE]}),
+             scratch=BULK_SIZE),
+    scenario('bulk delete authors', 'DELETE', '/authors/bulk',
+             lambda catalog, i: ('/authors/bulk', {
+                 'ids': catalog['scratch_authors'][i * BULK_SIZE:
+                                                   (i + 1) * BULK_SIZE]}),
+             scratch=BULK_SIZE)
+]
+
+
+def uncovered_routes(app, scenarios=SCENARIOS):
+    """Routes of ``app`` that no scenario exercises."""
+    covered = {(s.rule, s.method) for s in scenarios}
+    routes = set()
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        for method in rule.methods - {'HEAD', 'OPTIONS'}:
+            routes.add((rule.rule, method))
+    return sorted(routes - covered)
+
+
+def seed_catalog(app, authors, books):
+    """Insert a deterministic catalog; the database must be empty."""
+    with app.app_context():
+        db.create_all()
+        if Author.query.limit(1).count() or Book.query.limit(1).count():
+            raise RuntimeError('%s already holds a catalog, benchmark an '
+                               'empty database' % db.engine.url)
+
+        # One transaction, so every row shares one change revision
+        with db.engine.begin() as connection:
+            for start in range(0, authors, SEED_CHUNK):
+                connection.execute(Author.__table__.insert(), [
+                    {'name': 'author%d' % i, 'full_name': 'Author %d' % i,
+                     'dob': author_dates(i)}
+                    for i in range(start, min(start + SEED_CHUNK, authors))])
+
+            for start in range(0, books, SEED_CHUNK):
+                connection.execute(Book.__table__.insert(), [
+                    {'title': 'book%d' % i,
+                     'description': 'description %d' % i,
+                     'release_date': book_dates(i),
+                     'author_id': i % authors + 1}
+                    for i in range(start, min(start + SEED_CHUNK, books))])
+
+        bump_revision('authors', 'books')
+        db.session.commit()
+
+
+def add_scratch_rows(app, catalog, scenarios, requests):
+    """Rows for the delete scenarios, so they never touch the catalog."""
+    needed = {'DELETE /books': 0, 'DELETE /authors': 0}
+    for s in scenarios:
+        if s.scratch:
+            key = 'DELETE /' + s.rule.split('/')[1]
+            needed[key] += s.scratch * (count_for(s, requests) + 2)
+
+    with app.app_context():
+        first = db.session.query(func.max(Author.id)).scalar() + 1
+        Author.insert_many([
+            {'name': 'scratch%d' % i, 'full_name': 'Scratch Author',
+             'dob': date(1970, 1, 1)}
+            for i in range(needed['DELETE /authors'])])
+        first_book = db.session.query(func.max(Book.id)).scalar() + 1
+        Book.insert_many([
+            {'title': 'scratch%d' % i, 'description': None,
+             'release_date': date(2020, 1, 1), 'author_id': 1}
+            for i in range(needed['DELETE /books'])])
+        db.session.remove()
+
+    catalog['scratch_authors'] = list(
+        range(first, first + needed['DELETE /authors']))
+    catalog['scratch_books'] = list(
+        range(first_book, first_book + needed['DELETE /books']))
+
+
+def count_for(s, requests):
+    return min(requests, s.requests) if s.requests else requests
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+        event.listen(Engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def close(self):
+        event.remove(Engine, 'before_cursor_execute', self)
+
+
+def send(client, s, catalog, i, headers):
+    path, body = s.build(catalog, i)
+    res = client.open(path, method=s.method, headers=headers, json=body)
+    res.get_data()
+    res.close()
+    return res.status_code
+
+
+def measure(client, s, catalog, headers, requests, queries):
+    requests = count_for(s, requests)
+
+    # One warm-up request, then one under tracemalloc for the peak
+    # allocation, both outside the timed run.
+    send(client, s, catalog, 0, headers)
+    tracemalloc.start()
+    send(client, s, catalog, 1, headers)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    statuses = Counter()
+    latencies = []
+    queries.count = 0
+    started = time.perf_counter()
+    for i in range(2, requests + 2):
+        request_started = time.perf_counter()
+        statuses[send(client, s, catalog, i, headers)] += 1
+        latencies.append(time.perf_counter() - request_started)
+    elapsed = time.perf_counter() - started
+
+    def ms(seconds):
+        return round(seconds * 1000, 3)
+
+    return {
+        'name': s.name,
+        'method': s.method,
+        'route': s.rule,
+        'requests': requests,
+        'errors': sum(count for status, count in statuses.items()
+                      if status >= 400),
+        'statuses': {str(status): count
+                     for status, count in sorted(statuses.items())},
+        'throughput_rps': round(requests / elapsed, 1),
+        'latency_ms': {
+            'mean': ms(elapsed / requests),
+            'p50': ms(percentile(latencies, 0.5)),
+            'p90': ms(percentile(latencies, 0.9)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(max(latencies))
+        },
+        'queries_per_request': round(queries.count / requests, 2),
+        'peak_alloc_kb': round(peak / 1024.0, 1)
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment(url):
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'flask': flask.__version__,
+        'sqlalchemy': sqlalchemy.__version__,
+        'database': make_url(url).get_backend_name(),
+        'started_at': datetime.utcnow().isoformat() + 'Z'
+    }
+
+
+def run(authors=1000, books=100000, database=None, requests=200,
+        cache_type='none', only=None):
+    scenarios = [s for s in SCENARIOS
+                 if only is None or any(word in s.name for word in only)]
+
+    signer = LocalSigner(auth.AUTH0_DOMAIN, auth.API_AUDIENCE, bits=2048)
+    auth.jwks_store = JWKSKeyStore(signer.jwks_url)
+    auth.jwks_store.add_listener(auth.token_cache.evict_kids)
+    headers = {'Authorization': 'Bearer ' + signer.token(ALL_PERMISSIONS)}
+
+    directory = tempfile.TemporaryDirectory()
+    url = database or 'sqlite:///' + os.path.join(directory.name, 'bench.db')
+    queries = QueryCounter()
+    try:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': url,
+                          'CACHE_TYPE': cache_type})
+        missing = uncovered_routes(app)
+        if missing:
+            raise RuntimeError('No benchmark scenario for %s' % ', '.join(
+                '%s %s' % (method, rule) for rule, method in missing))
+
+        started = time.perf_counter()
+        seed_catalog(app, authors, books)
+        seed_seconds = time.perf_counter() - started
+
+        catalog = {'authors': authors, 'books': books}
+        add_scratch_rows(app, catalog, scenarios, requests)
+
+        client = app.test_client()
+        # A cursor about halfway into the first 10,000 books
+        cursor = None
+        for _ in range(max(min(books // 200, 50), 1)):
+            path = '/books?limit=100' + ('&cursor=' + cursor
+                                         if cursor else '')
+            cursor = client.get(path, headers=headers).get_json()[
+                'next_cursor'] or cursor
+        catalog['deep_cursor'] = cursor or ''
+
+        results = [measure(client, s, catalog, headers, requests, queries)
+                   for s in scenarios]
+
+        return {
+            'environment': environment(url),
+            'settings': {'authors': authors, 'books': books,
+                         'requests': requests, 'cache_type': cache_type,
+                         'bulk_size': BULK_SIZE},
+            'seed_seconds': round(seed_seconds, 2),
+            'peak_rss_mb': round(resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+            'results': results
+        }
+    finally:
+        queries.close()
+        signer.close()
+        directory.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark every API route against a seeded catalog.')
+    parser.add_argument('--authors', type=int, default=1000)
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--database',
+                        help='URL of an empty database (default: a fresh '
+                             'SQLite file)')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--cache', default='none',
+                        choices=('none', 'local'))
+    parser.add_argument('--only', nargs='*',
+                        help='run the scenarios whose name contains one of '
+                             'these words')
+    parser.add_argument('--output', default='benchmark-results.json')
+    args = parser.parse_args(argv)
+
+    report = run(args.authors, args.books, args.database, args.requests,
+                 args.cache, args.only)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for result in report['results']:
+        print('%-34s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  '
+              '%5.1f queries  %8.1f KB  %d errors' % (
+                  result['name'], result['throughput_rps'],
+                  result['latency_ms']['p50'], result['latency_ms']['p99'],
+                  result['queries_per_request'], result['peak_alloc_kb'],
+                  result['errors']))
+    print('peak RSS %.1f MB, results in %s' % (
+        report['peak_rss_mb'], args.output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
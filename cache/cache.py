@@ -0,0 +1,268 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, request, make_response
+
+from database.replicas import SharedStickyClients
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - optional dependency
+    redis = None
+
+
+class LocalBackend:
+    """In-process LRU with a per-entry TTL.
+
+    Every gunicorn worker has its own copy, so writes served by one worker
+    reach the others only after ``ttl`` seconds. Use ``RedisBackend`` when
+    that is not acceptable.
+    """
+
+    # Tag versions only see this worker's writes
+    shared = False
+
+    def __init__(self, maxsize=1024, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if self.clock() >= expires_at:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_versions(self, tags):
+        versions = self._versions
+        return [versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Cache shared by every worker, stored in Redis (or a stand-in).
+
+    ``client`` needs ``get``, ``set(ex=)``, ``delete``, ``mget`` and
+    ``incr``; ``cache.testing.FakeRedis`` provides them in-process.
+    """
+
+    shared = True
+
+    def __init__(self, client, ttl=60, prefix='bookstore:cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def get_versions(self, tags):
+        if not tags:
+            return []
+        raw = self.client.mget([self.prefix + 'v:' + tag for tag in tags])
+        return [int(version or 0) for version in raw]
+
+    def bump(self, tags):
+        for tag in tags:
+            self.client.incr(self.prefix + 'v:' + tag)
+
+    def clear(self):
+        pass
+
+
+class ResponseCache:
+    """Caches successful GET responses and invalidates them by tag.
+
+    Each cached route declares tags, formatted with the route's URL
+    arguments (``'book:{book_id}'``). An entry remembers the tag versions
+    it was built under; ``invalidate`` bumps versions so every entry that
+    carries one of the tags is treated as stale on its next read.
+
+    Tag versions of the ``local`` backend only see this worker's writes,
+    so its entries also remember the catalog ETag that ``@conditional``
+    read from the database, and are stale once it changes: the body
+    served is never older than the ETag sent with it. Tags of a shared
+    backend see every write and are precise enough on their own, except
+    for entries built from a read replica, which may lag behind them.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def cached(self, *tag_templates):
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                # Unbounded pages are too large to keep, and the view checks
+                # the permission they need, so they always go through it
+                if self.backend is None \
+                        or request.args.get('all', '').lower() == 'true':
+                    return f(*args, **kwargs)
+
+                tags = [template.format(**kwargs)
+                        for template in tag_templates]
+                key = request.full_path
+                versions = self.backend.get_versions(tags)
+                etag = g.pop('catalog_etag', None)
+                replica = reads_from_replica()
+
+                entry = self.backend.get(key)
+                if entry is not None:
+                    if entry['versions'] == versions \
+                            and self._fresh(entry, etag):
+                        self.hits += 1
+                        return self._restore(entry, 'HIT')
+
+                    self.backend.delete(key)
+                    self.invalidations += 1
+
+                self.misses += 1
+                response = make_response(f(*args, **kwargs))
+
+                if response.status_code == 200 \
+                        and not response.is_streamed:
+                    self.backend.set(key, {
+                        'versions': versions,
+                        'etag': etag,
+                        'replica': replica,
+                        'status': response.status_code,
+                        'mimetype': response.mimetype,
+                        'body': response.get_data(as_text=True)
+                    })
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return cached_decorator
+
+    def _fresh(self, entry, etag):
+        # Shared tags see every write, but a replica may not have applied
+        # it yet when the entry was built, so only its ETag can tell.
+        if self.backend.shared and not entry.get('replica'):
+            return True
+        return entry.get('etag') == etag
+
+    def invalidate(self, *tags):
+        if self.backend is not None and tags:
+            self.backend.bump(tags)
+
+    def _restore(self, entry, status):
+        response = make_response(entry['body'], entry['status'])
+        response.mimetype = entry['mimetype']
+        response.headers['X-Cache'] = status
+        return response
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+            'evictions': getattr(self.backend, 'evictions', 0)
+        }
+
+
+def reads_from_replica():
+    router = current_app.extensions.get('replica_router')
+    return router is not None and router.engine_for_request() is not None
+
+
+def setup_cache(app):
+    """Build the response cache configured by ``CACHE_TYPE``.
+
+    ``local`` (default) is an in-process LRU, ``redis`` shares entries
+    through ``CACHE_URL`` and ``none`` disables caching.
+    """
+    app.config.setdefault('CACHE_TYPE', os.environ.get('CACHE_TYPE', 'local'))
+    app.config.setdefault('CACHE_TTL', int(os.environ.get('CACHE_TTL', 60)))
+    app.config.setdefault('CACHE_SIZE',
+                          int(os.environ.get('CACHE_SIZE', 1024)))
+    app.config.setdefault('CACHE_URL', os.environ.get('CACHE_URL'))
+
+    cache_type = app.config['CACHE_TYPE']
+    ttl = app.config['CACHE_TTL']
+
+    if cache_type == 'none':
+        backend = None
+    elif cache_type == 'redis':
+        client = app.config.get('CACHE_CLIENT')
+        if client is None:
+            if redis is None:
+                raise RuntimeError('CACHE_TYPE=redis requires redis-py')
+            client = redis.Redis.from_url(app.config['CACHE_URL'])
+        backend = RedisBackend(client, ttl=ttl)
+    else:
+        backend = LocalBackend(maxsize=app.config['CACHE_SIZE'], ttl=ttl)
+
+    # Writes must pin their client to the primary on every worker
+    router = app.extensions.get('replica_router')
+    if router is not None and cache_type == 'redis':
+        router.sticky = SharedStickyClients(client)
+
+    response_cache = ResponseCache(backend)
+    app.extensions['response_cache'] = response_cache
+    return response_cache
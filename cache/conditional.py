@@ -0,0 +1,52 @@
+from datetime import timezone
+from functools import wraps
+
+from flask import g, request, make_response
+
+from database.models import get_revisions
+
+
+def conditional(*tables):
+    """Answer conditional GETs from the revisions of ``tables``.
+
+    The ETag is built from the catalog revision of every table the route
+    reads, so it is compared, and a 304 returned, before the route runs
+    its query or serializes anything. It is also left in ``g`` for
+    :meth:`ResponseCache.cached` below it, which only serves entries that
+    were built under the same ETag.
+    """
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            revisions, last_modified = get_revisions(tables)
+            etag = '-'.join('%s.%d' % (table, revisions[table])
+                            for table in tables)
+
+            if last_modified is not None:
+                last_modified = last_modified.replace(
+                    microsecond=0, tzinfo=timezone.utc)
+
+            if is_not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                g.catalog_etag = etag
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return conditional_decorator
+
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= request.if_modified_since
+
+    return False
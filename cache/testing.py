@@ -0,0 +1,46 @@
+"""In-process stand-in for the Redis commands used by ``RedisBackend``."""
+import threading
+import time
+
+
+class FakeRedis:
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at is not None and self.clock() >= expires_at:
+            del self._data[key]
+            return None
+        return value
+
+    def get(self, key):
+        with self._lock:
+            return self._live(key)
+
+    def mget(self, keys):
+        with self._lock:
+            return [self._live(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        expires_at = None if ex is None else self.clock() + ex
+        with self._lock:
+            self._data[key] = (str(value).encode(), expires_at)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._live(key) or 0) + 1
+            self._data[key] = (str(value).encode(), None)
+            return value
@@ -0,0 +1,95 @@
+"""Incremental change feed over the catalog tables.
+
+A sync token records, per source, the last position a client has seen:
+``(revision, id)`` for books, authors and deletion tombstones. Every
+write stamps its rows with the change revision of its transaction, which
+commit in order (see ``change_revision``), so a token never moves past a
+row that was still uncommitted when it was read. Each source is read with
+a keyset query on its ``(revision, id)`` index, so a sync costs
+O(changes) rather than O(table).
+"""
+import base64
+import json
+
+from sqlalchemy import or_
+
+from database.models import db, Book, Author, Tombstone, MAX_ID
+
+BOOK_COLUMNS = (Book.id, Book.title, Book.description, Book.release_date,
+                Book.author_id, Book.updated_at)
+AUTHOR_COLUMNS = (Author.id, Author.name, Author.full_name, Author.dob,
+                  Author.updated_at)
+TOMBSTONE_COLUMNS = (Tombstone.table_name, Tombstone.row_id)
+
+SOURCES = (('books', 'b'), ('authors', 'a'), ('deleted', 'd'))
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def initial_position():
+    return {source: (0, 0) for source, _ in SOURCES}
+
+
+def encode_token(position):
+    raw = json.dumps({key: list(position[source]) for source, key in SOURCES},
+                     separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_token(token):
+    if not token:
+        return initial_position()
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        position = {}
+        for source, key in SOURCES:
+            revision, last_id = raw[key]
+            # Both are INTEGER columns; larger values overflow the driver
+            if not all(type(value) is int and 0 <= value <= MAX_ID
+                       for value in (revision, last_id)):
+                raise ValueError(key)
+            position[source] = (revision, last_id)
+        return position
+    except Exception:
+        raise InvalidToken('since token is malformed')
+
+
+def _changed_rows(model, columns, after, limit):
+    revision, last_id = after
+    rows = db.session.query(model.revision, model.id, *columns).filter(
+        model.revision >= revision,
+        or_(model.revision > revision, model.id > last_id)
+    ).order_by(model.revision, model.id).limit(limit + 1).all()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        after = tuple(rows[-1][:2])
+    names = [column.key for column in columns]
+    return [dict(zip(names, row[2:])) for row in rows], after, more
+
+
+def get_changes(token, limit):
+    """Return the changes after ``token`` and the token to resume from."""
+    position = decode_token(token)
+
+    books, position['books'], more_books = _changed_rows(
+        Book, BOOK_COLUMNS, position['books'], limit)
+    authors, position['authors'], more_authors = _changed_rows(
+        Author, AUTHOR_COLUMNS, position['authors'], limit)
+    tombstones, position['deleted'], more_deleted = _changed_rows(
+        Tombstone, TOMBSTONE_COLUMNS, position['deleted'], limit)
+
+    return {
+        'books': books,
+        'authors': authors,
+        'deleted': [{'table': tombstone['table_name'],
+                     'id': tombstone['row_id']}
+                    for tombstone in tombstones],
+        'has_more': more_books or more_authors or more_deleted,
+        'next_token': encode_token(position)
+    }
@@ -0,0 +1,179 @@
+"""Column-level read path for the list routes.
+
+Listings select plain column tuples and build the response dicts from
+the rows directly, skipping ORM instances and the identity map. Without
+``fields=`` the shape is the one of ``Book.short()``/``Author.short()``;
+with it only the requested columns are selected. Each ``include=`` is
+filled in with one batched query over the ids of the page, so the cost
+is two queries regardless of page size. A to-many include embeds at most
+``INCLUDE_MAX_ITEMS`` records per parent and flags the ones it cut short.
+"""
+import os
+
+from sqlalchemy import func
+
+from database.models import db, Book, Author, chunked, NO_AUTHOR
+
+INCLUDE_MAX_ITEMS = int(os.environ.get('INCLUDE_MAX_ITEMS', 100))
+
+
+class FieldsetError(ValueError):
+    pass
+
+
+def split_arg(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    items = [item.strip() for item in value.split(',')]
+    if not all(items):
+        raise FieldsetError('%s is malformed' % name)
+    return list(dict.fromkeys(items))
+
+
+class Fieldset:
+    """Columns and includes a client may ask for on one resource.
+
+    ``columns`` maps a field name to a column expression, ``default`` is
+    the shape returned without ``fields=`` (the ``short()`` shape) and
+    ``includes`` maps an include name to its :class:`Include`.
+    """
+
+    def __init__(self, model, columns, default, includes):
+        self.model = model
+        self.columns = columns
+        self.default = default
+        self.includes = includes
+
+    def select(self, args):
+        names = split_arg(args, 'fields')
+        includes = split_arg(args, 'include') or []
+
+        if names is None:
+            names = list(self.default)
+        else:
+            unknown = [name for name in names if name not in self.columns]
+            if unknown:
+                raise FieldsetError(
+                    'unknown field: %s' % ', '.join(unknown))
+            if 'id' not in names:
+                names.insert(0, 'id')
+
+        unknown = [name for name in includes if name not in self.includes]
+        if unknown:
+            raise FieldsetError('unknown include: %s' % ', '.join(unknown))
+
+        return Selection(self, names, includes)
+
+
+class Selection:
+    """The fields and includes requested for one response."""
+
+    def __init__(self, fieldset, names, includes):
+        self.fieldset = fieldset
+        self.names = [name for name in names if name not in includes]
+        self.includes = includes
+
+    def query(self):
+        """A column query for the selected fields and include keys."""
+        columns = self.fieldset.columns
+        selected = [columns[name].label(name) for name in self.names]
+        query = db.session.query(*selected)
+
+        for include in self.includes:
+            key = self.fieldset.includes[include].key
+            if key not in self.names:
+                query = query.add_columns(columns[key].label(key))
+
+        if 'author' in self.names:
+            query = query.select_from(Book) \
+                .outerjoin(Author, Book.author_id == Author.id)
+        return query
+
+    def render(self, rows):
+        # The selected fields are the leading columns of every row.
+        names = self.names
+        items = [dict(zip(names, row)) for row in rows]
+
+        for include in self.includes:
+            self.fieldset.includes[include].load(rows, items)
+        return items
+
+
+class Include:
+    """Embed related records found through ``key`` with one query."""
+
+    def __init__(self, name, key, model, foreign_key, columns, many):
+        self.name = name
+        self.key = key
+        self.model = model
+        self.foreign_key = foreign_key
+        self.columns = columns
+        self.many = many
+
+    def load(self, rows, items):
+        ids = {getattr(row, self.key) for row in rows} - {None}
+        related = {}
+
+        for chunk in chunked(list(ids)):
+            for record in self._records(chunk):
+                owner = record[self.foreign_key.key]
+                if self.many:
+                    related.setdefault(owner, []).append(record)
+                else:
+                    related[owner] = record
+
+        empty = [] if self.many else None
+        for row, item in zip(rows, items):
+            embedded = related.get(getattr(row, self.key), empty)
+            if not self.many:
+                item[self.name] = embedded
+                continue
+
+            item[self.name] = embedded[:INCLUDE_MAX_ITEMS]
+            item[self.name + '_truncated'] = \
+                len(embedded) > INCLUDE_MAX_ITEMS
+
+    def _records(self, ids):
+        if not self.many:
+            query = db.session.query(*self.columns) \
+                .filter(self.foreign_key.in_(ids))
+            return [dict(record._mapping) for record in query]
+
+        # One more than the cap per parent, so a cut can be reported
+        # without loading every child.
+        rank = func.row_number().over(
+            partition_by=self.foreign_key,
+            order_by=self.model.id).label('rank')
+        ranked = db.session.query(*self.columns, rank) \
+            .filter(self.foreign_key.in_(ids)).subquery()
+        columns = [ranked.c[column.key] for column in self.columns]
+        query = db.session.query(*columns) \
+            .filter(ranked.c.rank <= INCLUDE_MAX_ITEMS + 1) \
+            .order_by(ranked.c[self.foreign_key.key], ranked.c.id)
+        return [dict(record._mapping) for record in query]
+
+
+BOOK_FIELDSET = Fieldset(Book, columns={
+    'id': Book.id,
+    'title': Book.title,
+    'description': Book.description,
+    'release_date': Book.release_date,
+    'author_id': Book.author_id,
+    'author': func.coalesce(Author.name, NO_AUTHOR)
+}, default=['id', 'title', 'author'], includes={
+    'author': Include('author', 'author_id', Author, Author.id,
+                      (Author.id, Author.name, Author.full_name,
+                       Author.dob), many=False)
+})
+
+AUTHOR_FIELDSET = Fieldset(Author, columns={
+    'id': Author.id,
+    'name': Author.name,
+    'full_name': Author.full_name,
+    'dob': Author.dob
+}, default=['id', 'name'], includes={
+    'books': Include('books', 'id', Book, Book.author_id,
+                     (Book.id, Book.title, Book.release_date,
+                      Book.author_id), many=True)
+})
@@ -0,0 +1,124 @@
+"""Validated filter and sort parameters for the list routes.
+
+Every accepted parameter maps to an indexed column, so filters become a
+WHERE clause and the sort becomes the keyset ORDER BY; anything else in
+the query string is rejected before a query is built.
+"""
+import operator
+from datetime import datetime
+
+from database.models import Book, Author, MAX_ID
+
+# Parameters owned by pagination, batch lookups and fieldsets.
+RESERVED_ARGS = frozenset(['limit', 'cursor', 'all', 'ids', 'fields',
+                           'include'])
+DATE_FORMATS = ('%Y/%m/%d', '%Y-%m-%d')
+
+
+class FilterError(ValueError):
+    pass
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
+def parse_id(value):
+    # Larger values cannot match and would overflow the driver
+    value = int(value)
+    if not 1 <= value <= MAX_ID:
+        raise ValueError(value)
+    return value
+
+
+class Listing:
+    """Filters and sort keys allowed on one list route.
+
+    ``filters`` maps a query parameter to ``(column, operator, parse)``;
+    ``sorts`` maps a ``sort`` value to a column. ``id`` is always the
+    tiebreak, so pages stay stable when sort values repeat.
+    """
+
+    def __init__(self, model, filters, sorts):
+        self.model = model
+        self.filters = filters
+        self.sorts = sorts
+
+    def without(self, *names):
+        """This listing minus the filters its route fixes in the path."""
+        return Listing(self.model, {
+            name: spec for name, spec in self.filters.items()
+            if name not in names}, self.sorts)
+
+    def parse(self, args):
+        """Return (criteria, sort_column, descending) for ``args``."""
+        unknown = set(args) - RESERVED_ARGS - set(self.filters) \
+            - {'sort', 'order'}
+        if unknown:
+            raise FilterError(
+                'unknown parameter: %s' % ', '.join(sorted(unknown)))
+
+        criteria = []
+        for name, (column, compare, parse) in self.filters.items():
+            if name not in args:
+                continue
+            try:
+                value = parse(args[name])
+            except (TypeError, ValueError):
+                raise FilterError('%s is invalid' % name)
+            criteria.append(compare(column, value))
+
+        sort = args.get('sort', 'id')
+        if sort not in self.sorts:
+            raise FilterError('sort must be one of: %s'
+                              % ', '.join(sorted(self.sorts)))
+
+        order = args.get('order', 'asc')
+        if order not in ('asc', 'desc'):
+            raise FilterError('order must be asc or desc')
+
+        return criteria, self.sorts[sort], order == 'desc'
+
+    def apply(self, page, query, args):
+        """Filter, sort and paginate ``query``; return (rows, next_cursor)."""
+        criteria, key, descending = self.parse(args)
+        query = query.filter(*criteria)
+
+        # A column query must carry the sort key to build the cursor.
+        descriptions = query.column_descriptions
+        if all(d['expr'] is not self.model for d in descriptions) and \
+                key.key not in {d['name'] for d in descriptions}:
+            query = query.add_columns(key)
+
+        if key is self.model.id:
+            return page.apply(query, key, descending=descending)
+        return page.apply(query, key, tiebreak=self.model.id,
+                          descending=descending)
+
+
+BOOK_LISTING = Listing(Book, filters={
+    'author_id': (Book.author_id, operator.eq, parse_id),
+    'released_after': (Book.release_date, operator.ge, parse_date),
+    'released_before': (Book.release_date, operator.le, parse_date)
+}, sorts={
+    'id': Book.id,
+    'title': Book.title,
+    'release_date': Book.release_date
+})
+
+# /books/author/<author_id>: the author comes from the path
+AUTHOR_BOOK_LISTING = BOOK_LISTING.without('author_id')
+
+AUTHOR_LISTING = Listing(Author, filters={
+    'born_after': (Author.dob, operator.ge, parse_date),
+    'born_before': (Author.dob, operator.le, parse_date)
+}, sorts={
+    'id': Author.id,
+    'name': Author.name,
+    'dob': Author.dob
+})
@@ -1,21 +1,146 @@
 import os
+from datetime import datetime
 from sqlalchemy import ForeignKey, Column, String, Integer, \
-    Date, create_engine
-from sqlalchemy.orm import relationship
+    Date, DateTime, Index, create_engine, func, select
+from sqlalchemy.orm import relationship, joinedload
 from flask_sqlalchemy import SQLAlchemy
 import json
 import os
 from flask_migrate import Migrate
 
+from database.pool import engine_options
+from database.replicas import RoutingSQLAlchemy, setup_replicas
+
 database_path = os.environ['DATABASE_URL']
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+
+# Keeps IN (...) lists under the bound parameter limit of every backend.
+IN_CHUNK_SIZE = 500
+
+# Largest value of the INTEGER primary keys; bigger ids overflow the driver.
+MAX_ID = 2 ** 31 - 1
+
+# catalog_revisions row that orders the writes for the change feed.
+CHANGES = 'changes'
+
+# Shown as the author of books whose author was deleted.
+NO_AUTHOR = "Not have author"
+
+
+def chunked(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        yield ids[start:start + IN_CHUNK_SIZE]
+
+
+def existing_ids(column, ids):
+    """Return the subset of ``ids`` present in ``column``."""
+    existing = set()
+    # Out of range ids cannot exist and would overflow the driver
+    ids = [value for value in ids if 1 <= value <= MAX_ID]
+
+    for chunk in chunked(ids):
+        existing.update(
+            value for value, in
+            db.session.query(column).filter(column.in_(chunk)))
+    return existing
+
+
+def change_revision(connection):
+    """Return the change revision of the transaction on ``connection``.
+
+    Every catalog row a transaction writes is stamped with it. It is taken
+    by bumping the ``changes`` row of catalog_revisions the first time the
+    transaction writes, and that row stays locked until the transaction
+    ends, so revisions commit in order: once a reader sees revision n,
+    every smaller revision is already visible.
+    """
+    transaction = connection.get_transaction()
+    taken = connection.info.get('change_revision')
+    if taken is not None and taken[0] is transaction:
+        return taken[1]
+
+    table = CatalogRevision.__table__
+    row = table.c.table_name == CHANGES
+    bump = table.update().where(row).values(
+        revision=table.c.revision + 1, updated_at=datetime.utcnow())
+
+    if connection.dialect.full_returning:
+        revision = connection.execute(
+            bump.returning(table.c.revision)).scalar()
+    elif connection.execute(bump).rowcount:
+        revision = connection.execute(select(table.c.revision).where(row)) \
+            .scalar()
+    else:
+        revision = None
+
+    if revision is None:
+        revision = 1
+        connection.execute(table.insert().values(
+            table_name=CHANGES, revision=1, updated_at=datetime.utcnow()))
+
+    if transaction is not None:
+        connection.info['change_revision'] = (transaction, revision)
+    return revision
+
+
+def stamp_revision(context):
+    return change_revision(context.connection)
+
+
+def bump_revision(*tables):
+    """Advance the revision of ``tables`` inside the current transaction.
+
+    Called by every model write right before it commits, so a reader that
+    sees the new rows also sees the new revision. The change revision is
+    taken first, so concurrent writers always lock the rows in the same
+    order.
+    """
+    change_revision(db.session.connection())
+    now = datetime.utcnow()
+
+    for table in tables:
+        updated = CatalogRevision.query \
+            .filter(CatalogRevision.table_name == table) \
+            .update({
+                'revision': CatalogRevision.revision + 1,
+                'updated_at': now
+            }, synchronize_session=False)
+
+        if not updated:
+            db.session.add(CatalogRevision(table_name=table, revision=1,
+                                           updated_at=now))
+
+
+def get_revisions(tables):
+    """Return ({table: revision}, last updated_at) for ``tables``."""
+    revisions = dict.fromkeys(tables, 0)
+    last_modified = None
+
+    rows = db.session.query(
+        CatalogRevision.table_name,
+        CatalogRevision.revision,
+        CatalogRevision.updated_at
+    ).filter(CatalogRevision.table_name.in_(list(tables)))
+
+    for table_name, revision, updated_at in rows:
+        revisions[table_name] = revision
+        if last_modified is None or updated_at > last_modified:
+            last_modified = updated_at
+    return revisions, last_modified
 
 
 def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config.setdefault("SQLALCHEMY_DATABASE_URI", database_path)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(
+        app.config["SQLALCHEMY_DATABASE_URI"]))
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
+    setup_replicas(app, engine_options)
     migrate = Migrate(app, db)
 
 
@@ -28,8 +153,19 @@ class Book(db.Model):
     description = Column(String)
     release_date = Column(Date)
     author_id = Column(Integer, ForeignKey("authors.id"))
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
+    revision = Column(Integer, nullable=False, default=stamp_revision,
+                      onupdate=stamp_revision)
     author = relationship("Author", back_populates="books")
 
+    __table_args__ = (
+        Index('ix_books_author_id', 'author_id'),
+        Index('ix_books_title', 'title'),
+        Index('ix_books_release_date_id', 'release_date', 'id'),
+        Index('ix_books_revision_id', 'revision', 'id'),
+    )
+
     def __init__(self, title, description, release_date, author_id):
         self.title = title
         self.description = description
@@ -38,20 +174,81 @@ class Book(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_revision('books')
         db.session.commit()
 
     def update(self):
+        bump_revision('books')
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        Tombstone.record('books', [self.id])
+        bump_revision('books')
+        db.session.commit()
+
+    @staticmethod
+    def insert_many(rows):
+        """Insert column dicts with one executemany in one transaction."""
+        db.session.execute(Book.__table__.insert(), rows)
+        bump_revision('books')
+        db.session.commit()
+
+    @staticmethod
+    def get_many(book_ids):
+        """Return {book_id: book} for the listed ids, authors included."""
+        books = {}
+
+        for chunk in chunked(book_ids):
+            query = Book.query.options(joinedload(Book.author)) \
+                .filter(Book.id.in_(chunk))
+            books.update((book.id, book) for book in query)
+        return books
+
+    @staticmethod
+    def update_many(book_ids, values):
+        """Apply ``values`` to every listed book with one UPDATE."""
+        affected = existing_ids(Book.id, book_ids)
+        for chunk in chunked(affected):
+            Book.query.filter(Book.id.in_(chunk)) \
+                .update(values, synchronize_session=False)
+        bump_revision('books')
+        db.session.commit()
+        return sorted(affected)
+
+    @staticmethod
+    def delete_many(book_ids):
+        """Delete every listed book with one DELETE."""
+        affected = existing_ids(Book.id, book_ids)
+        for chunk in chunked(affected):
+            Book.query.filter(Book.id.in_(chunk)) \
+                .delete(synchronize_session=False)
+        Tombstone.record('books', affected)
+        bump_revision('books')
         db.session.commit()
+        return sorted(affected)
+
+    @staticmethod
+    def export_rows(batch_size=EXPORT_BATCH_SIZE):
+        """Yield every book as a dict, streamed from a server-side cursor."""
+        query = db.session.query(
+            Book.id,
+            Book.title,
+            Book.description,
+            Book.release_date,
+            Book.author_id,
+            Author.name.label('author')
+        ).outerjoin(Author, Book.author_id == Author.id) \
+            .order_by(Book.id).yield_per(batch_size)
+
+        for row in query:
+            yield dict(row._mapping)
 
     def short(self):
         return {
             'id': self.id,
             'title': self.title,
-            'author': self.author.name if self.author else "Not have author"
+            'author': self.author.name if self.author else NO_AUTHOR
         }
 
     def long(self):
@@ -60,7 +257,7 @@ class Book(db.Model):
             'title': self.title,
             'description': self.description,
             'release_date': self.release_date,
-            'author': self.author.name if self.author else "Not have author"
+            'author': self.author.name if self.author else NO_AUTHOR
         }
 
 
@@ -72,8 +269,18 @@ class Author(db.Model):
     name = Column(String)
     full_name = Column(String)
     dob = Column(Date)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
+    revision = Column(Integer, nullable=False, default=stamp_revision,
+                      onupdate=stamp_revision)
     books = relationship('Book', back_populates="author")
 
+    __table_args__ = (
+        Index('ix_authors_name', 'name'),
+        Index('ix_authors_dob_id', 'dob', 'id'),
+        Index('ix_authors_revision_id', 'revision', 'id'),
+    )
+
     def __init__(self, name, full_name, dob):
         self.name = name
         self.full_name = full_name
@@ -81,14 +288,68 @@ class Author(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_revision('authors')
         db.session.commit()
 
     def update(self):
+        bump_revision('authors')
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        Tombstone.record('authors', [self.id])
+        bump_revision('authors', 'books')
+        db.session.commit()
+
+    @staticmethod
+    def insert_many(rows):
+        """Insert column dicts with one executemany in one transaction."""
+        db.session.execute(Author.__table__.insert(), rows)
+        bump_revision('authors')
+        db.session.commit()
+
+    @staticmethod
+    def existing_ids(author_ids):
+        """Return the subset of ``author_ids`` present in the table."""
+        return existing_ids(Author.id, author_ids)
+
+    @staticmethod
+    def update_many(author_ids, values):
+        """Apply ``values`` to every listed author with one UPDATE."""
+        affected = existing_ids(Author.id, author_ids)
+        for chunk in chunked(affected):
+            Author.query.filter(Author.id.in_(chunk)) \
+                .update(values, synchronize_session=False)
+        bump_revision('authors')
         db.session.commit()
+        return sorted(affected)
+
+    @staticmethod
+    def delete_many(author_ids):
+        """Delete the listed authors, detaching their books like delete()."""
+        affected = existing_ids(Author.id, author_ids)
+        for chunk in chunked(affected):
+            Book.query.filter(Book.author_id.in_(chunk)) \
+                .update({'author_id': None}, synchronize_session=False)
+            Author.query.filter(Author.id.in_(chunk)) \
+                .delete(synchronize_session=False)
+        Tombstone.record('authors', affected)
+        bump_revision('authors', 'books')
+        db.session.commit()
+        return sorted(affected)
+
+    @staticmethod
+    def export_rows(batch_size=EXPORT_BATCH_SIZE):
+        """Yield every author as a dict, streamed from a server-side cursor."""
+        query = db.session.query(
+            Author.id,
+            Author.name,
+            Author.full_name,
+            Author.dob
+        ).order_by(Author.id).yield_per(batch_size)
+
+        for row in query:
+            yield dict(row._mapping)
 
     def short(self):
         return {
@@ -96,11 +357,82 @@ class Author(db.Model):
             'name': self.name
         }
 
-    def long(self):
+    def count_books(self):
+        return db.session.query(func.count(Book.id)) \
+            .filter(Book.author_id == self.id).scalar()
+
+    @staticmethod
+    def count_books_by_author(author_ids):
+        """Return {author_id: number_of_books} using one grouped COUNT."""
+        counts = dict.fromkeys(author_ids, 0)
+
+        for chunk in chunked(counts):
+            rows = db.session.query(Book.author_id, func.count(Book.id)) \
+                .filter(Book.author_id.in_(chunk)) \
+                .group_by(Book.author_id)
+            counts.update(rows)
+        return counts
+
+    @staticmethod
+    def get_many(author_ids):
+        """Return {author_id: author} for the listed ids that exist."""
+        authors = {}
+
+        for chunk in chunked(author_ids):
+            authors.update(
+                (author.id, author)
+                for author in Author.query.filter(Author.id.in_(chunk)))
+        return authors
+
+    @classmethod
+    def long_many(cls, authors):
+        counts = cls.count_books_by_author([author.id for author in authors])
+        return [author.long(counts[author.id]) for author in authors]
+
+    def long(self, number_of_books=None):
+        if number_of_books is None:
+            number_of_books = self.count_books()
+
         return {
             'id': self.id,
             'name': self.name,
             'full_name': self.full_name,
             'dob': self.dob,
-            'number_of_books': len(self.books)
+            'number_of_books': number_of_books
         }
+
+
+class CatalogRevision(db.Model):
+    """Monotonic revision per catalog table, used for HTTP validators."""
+
+    __tablename__ = 'catalog_revisions'
+
+    table_name = Column(String, primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class Tombstone(db.Model):
+    """Record of a deleted catalog row, read by the change feed."""
+
+    __tablename__ = 'tombstones'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    revision = Column(Integer, nullable=False, default=stamp_revision)
+
+    __table_args__ = (
+        Index('ix_tombstones_revision_id', 'revision', 'id'),
+    )
+
+    @staticmethod
+    def record(table_name, row_ids):
+        if not row_ids:
+            return
+
+        db.session.execute(Tombstone.__table__.insert(), [
+            {'table_name': table_name, 'row_id': row_id}
+            for row_id in sorted(row_ids)
+        ])
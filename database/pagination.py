@@ -0,0 +1,178 @@
+import base64
+import json
+import os
+from datetime import date
+
+from sqlalchemy import or_, false
+
+from database.models import MAX_ID
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+
+
+class PaginationError(ValueError):
+    pass
+
+
+class Page:
+    """Keyset page request: at most ``limit`` rows after ``cursor``.
+
+    ``limit`` is None when the caller explicitly asked for every row.
+    ``cursor`` is the decoded list of sort key values of the last row of
+    the previous page.
+    """
+
+    def __init__(self, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        self.limit = limit
+        self.cursor = cursor
+
+    @classmethod
+    def from_args(cls, args):
+        if args.get('all', '').lower() == 'true':
+            return cls(limit=None)
+
+        limit = args.get('limit', DEFAULT_PAGE_SIZE)
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise PaginationError('limit must be an integer')
+
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise PaginationError(
+                'limit must be between 1 and %d' % MAX_PAGE_SIZE)
+
+        cursor = args.get('cursor')
+        return cls(limit, decode_cursor(cursor) if cursor else None)
+
+    def apply(self, query, key, tiebreak=None, descending=False,
+              values=None):
+        """Return (rows, next_cursor) for ``query`` ordered by ``key``.
+
+        ``tiebreak`` (usually the primary key) orders rows sharing a
+        ``key`` value. ``values(row)`` returns the sort key values of a
+        row; by default they are read as attributes named after the keys.
+        Unlike OFFSET, a deep page costs the same as the first one as long
+        as the keys are indexed. NULLs in a nullable key sort as the
+        largest value on every backend, which is also the order a Postgres
+        btree index returns them in; they are fetched by a second query
+        once the non-NULL rows run out.
+        """
+        keys = [key] if tiebreak is None else [key, tiebreak]
+        if values is None:
+            def values(row):
+                return [getattr(row, k.key) for k in keys]
+
+        cursor = None
+        if self.cursor is not None:
+            if len(self.cursor) != len(keys):
+                raise PaginationError('cursor is malformed')
+            cursor = [coerce(k, value)
+                      for k, value in zip(keys, self.cursor)]
+
+        query = query.order_by(*[k.desc() if descending else k
+                                 for k in keys])
+        rows = []
+        for criteria in segments(keys, cursor, descending):
+            segment = query.filter(*criteria)
+            if self.limit is None:
+                rows.extend(segment.all())
+                continue
+
+            rows.extend(segment.limit(self.limit + 1 - len(rows)).all())
+            if len(rows) > self.limit:
+                rows = rows[:self.limit]
+                return rows, encode_cursor(*values(rows[-1]))
+
+        return rows, None
+
+
+def nullable(key):
+    return getattr(getattr(key, 'expression', key), 'nullable', False)
+
+
+def segments(keys, cursor, descending):
+    """Filter criteria of each run of rows after ``cursor``, in order.
+
+    Each run is one range scan of an index on ``keys``: the bound is
+    ``key >= :v AND (key > :v OR id > :id)`` rather than a bare OR, so
+    the database can seek to ``:v``. A nullable key is split into its
+    non-NULL rows and its NULL rows, which sort last (first when
+    descending) on every backend and are read as their own run.
+    """
+    key, rest = keys[0], keys[1:]
+    value = None if cursor is None else cursor[0]
+
+    def after(key, value):
+        return key < value if descending else key > value
+
+    def bound():
+        if not rest:
+            return [after(key, value)]
+        at_or_after = key <= value if descending else key >= value
+        return [at_or_after, or_(after(key, value), after(rest[0], cursor[1]))]
+
+    if not nullable(key):
+        return [bound() if cursor is not None else []]
+
+    present = [key.isnot(None)]
+    missing = [key.is_(None)]
+    if cursor is not None and value is None:
+        # The cursor is among the NULLs: only later NULLs remain, then
+        # (descending) every non-NULL row.
+        missing.append(after(rest[0], cursor[1]) if rest else false())
+        return [missing, present] if descending else [missing]
+
+    if cursor is not None:
+        present.extend(bound())
+        if descending:
+            return [present]
+    return [missing, present] if descending else [present, missing]
+
+
+def coerce(key, value):
+    """Convert a cursor value back to the Python type of ``key``."""
+    if value is None:
+        if not nullable(key):
+            raise PaginationError('cursor is malformed')
+        return None
+
+    try:
+        python_type = key.type.python_type
+    except (AttributeError, NotImplementedError):
+        return value
+
+    if python_type is date and isinstance(value, str):
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            raise PaginationError('cursor is malformed')
+
+    # Values the INTEGER columns cannot hold would overflow the driver
+    if python_type is int and (not isinstance(value, int) or
+                               not -MAX_ID <= value <= MAX_ID):
+        raise PaginationError('cursor is malformed')
+    if python_type is str and not isinstance(value, str):
+        raise PaginationError('cursor is malformed')
+    return value
+
+
+def encode_cursor(*values):
+    values = [value.isoformat() if isinstance(value, date) else value
+              for value in values]
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise PaginationError('cursor is malformed')
+
+    if not isinstance(values, list) or not values or not all(
+            value is None or isinstance(value, (int, float, str)) and
+            not isinstance(value, bool) for value in values):
+        raise PaginationError('cursor is malformed')
+    return values
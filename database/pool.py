@@ -0,0 +1,121 @@
+"""Connection pool settings and usage counters for the engine.
+
+Every gunicorn worker owns one pool, so ``DB_POOL_SIZE +
+DB_MAX_OVERFLOW`` times the worker count must stay under the server's
+connection limit.
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Below the idle timeout of RDS and most proxies, so a recycled
+# connection is replaced before the server drops it.
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() \
+    not in ('0', 'false', 'no')
+
+
+class MonitoredQueuePool(QueuePool):
+    """QueuePool that records checkouts, timeouts and time spent waiting."""
+
+    def __init__(self, *args, clock=time.perf_counter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.clock = clock
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        started = self.clock()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self._record(started, timed_out=True)
+            raise
+        self._record(started)
+        return connection
+
+    def _record(self, started, timed_out=False):
+        waited = self.clock() - started
+        with self._stats_lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def recreate(self):
+        # engine.dispose() swaps in a fresh pool; keep the counters
+        # cumulative across the swap.
+        pool = super().recreate()
+        pool.clock = self.clock
+        pool.checkouts = self.checkouts
+        pool.timeouts = self.timeouts
+        pool.wait_total = self.wait_total
+        pool.wait_max = self.wait_max
+        return pool
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'max_overflow': self._max_overflow,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': round(self.wait_total, 6),
+                'wait_seconds_max': round(self.wait_max, 6)
+            }
+
+
+class MonitoredAsyncQueuePool(MonitoredQueuePool, AsyncAdaptedQueuePool):
+    """The same counters for async drivers, waiting without blocking."""
+
+
+def queue_pool_options(is_async=False, **overrides):
+    """Engine keyword arguments for a monitored QueuePool."""
+    options = {
+        'poolclass': MonitoredAsyncQueuePool if is_async
+        else MonitoredQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+    options.update(overrides)
+    return options
+
+
+def engine_options(database_uri):
+    """Engine keyword arguments for ``database_uri``.
+
+    SQLite keeps SQLAlchemy's own pool choice: its in-memory and file
+    pools do not take size or overflow settings.
+    """
+    url = make_url(database_uri)
+    if url.get_backend_name() == 'sqlite':
+        return {}
+    return queue_pool_options(is_async=url.get_dialect().is_async)
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    if isinstance(pool, MonitoredQueuePool):
+        stats = pool.stats()
+    else:
+        stats = {'checked_out': pool.checkedout()} \
+            if hasattr(pool, 'checkedout') else {}
+    stats['pool'] = type(pool).__name__
+    return stats
@@ -0,0 +1,255 @@
+"""Read-replica routing for the authenticated GET routes.
+
+A GET handled by ``requires_auth`` reads from one replica, picked
+round-robin once per request so every query of the request (revision
+check included) sees the same snapshot. Everything else runs on the
+primary: writes, unauthenticated routes, and reads by a client that
+wrote within the last ``READ_YOUR_WRITES_SECONDS``, so it sees its own
+changes before they reach the replicas. A replica that fails to connect
+is ejected for ``REPLICA_EJECT_SECONDS`` and the request moves on to the
+next healthy replica, or the primary once none are left.
+
+Stickiness is tracked per worker, like the ``local`` response cache,
+unless the ``redis`` cache is configured: then every worker shares it, so
+a client's next read is routed right whichever worker serves it.
+"""
+import itertools
+import math
+import os
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, exc, orm
+
+READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+REPLICA_EJECT_SECONDS = float(os.environ.get('REPLICA_EJECT_SECONDS', 30))
+STICKY_MAX_CLIENTS = 10000
+
+READ_METHODS = ('GET', 'HEAD')
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class ReplicaSet:
+    """Round-robin over replica engines, skipping ejected ones."""
+
+    def __init__(self, engines, eject_seconds=REPLICA_EJECT_SECONDS,
+                 clock=time.monotonic):
+        self.engines = list(engines)
+        self.eject_seconds = eject_seconds
+        self.clock = clock
+        self._ejected = {}
+        self._cycle = itertools.cycle(range(len(self.engines)))
+        self._lock = threading.Lock()
+        self.ejections = 0
+
+    def choose(self):
+        """Return the next healthy engine, or None if all are ejected."""
+        now = self.clock()
+        with self._lock:
+            for _ in range(len(self.engines)):
+                index = next(self._cycle)
+                if self._ejected.get(index, 0) <= now:
+                    self._ejected.pop(index, None)
+                    return self.engines[index]
+        return None
+
+    def eject(self, engine):
+        index = self.engines.index(engine)
+        with self._lock:
+            if self._ejected.get(index, 0) <= self.clock():
+                self.ejections += 1
+            self._ejected[index] = self.clock() + self.eject_seconds
+
+    def healthy(self):
+        now = self.clock()
+        with self._lock:
+            return [engine for index, engine in enumerate(self.engines)
+                    if self._ejected.get(index, 0) <= now]
+
+
+class StickyClients:
+    """Clients that wrote recently and must read from the primary."""
+
+    def __init__(self, window=READ_YOUR_WRITES_SECONDS,
+                 maxsize=STICKY_MAX_CLIENTS, clock=time.monotonic):
+        self.window = window
+        self.maxsize = maxsize
+        self.clock = clock
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def mark(self, client):
+        now = self.clock()
+        with self._lock:
+            if len(self._until) >= self.maxsize:
+                self._until = {key: until
+                               for key, until in self._until.items()
+                               if until > now}
+            self._until[client] = now + self.window
+
+    def __contains__(self, client):
+        with self._lock:
+            return self._until.get(client, 0) > self.clock()
+
+
+class SharedStickyClients:
+    """:class:`StickyClients` kept in Redis, so every worker sees a write.
+
+    Marks expire on whole seconds, rounded up, which only makes a client
+    stick a little longer.
+    """
+
+    def __init__(self, client, window=READ_YOUR_WRITES_SECONDS,
+                 prefix='bookstore:sticky:'):
+        self.client = client
+        self.window = window
+        self.prefix = prefix
+
+    def mark(self, client):
+        key = self.prefix + str(client)
+        if self.window > 0:
+            self.client.set(key, 1, ex=max(1, math.ceil(self.window)))
+        else:
+            self.client.delete(key)
+
+    def __contains__(self, client):
+        return self.client.get(self.prefix + str(client)) is not None
+
+
+class ReplicaRouter:
+
+    def __init__(self, replicas, sticky):
+        self.replicas = replicas
+        self.sticky = sticky
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    def init_app(self, app):
+        for engine in self.replicas.engines:
+            event.listen(engine, 'handle_error', self._handle_error)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.extensions['replica_router'] = self
+
+    def _before_request(self):
+        # g belongs to the app context, which outlives the request when
+        # one was already pushed (tests, CLI commands).
+        g.pop('db_replica', None)
+        g.pop('principal', None)
+
+    def _handle_error(self, context):
+        # No connection means the replica could not be reached at all.
+        if context.is_disconnect or context.connection is None:
+            self.replicas.eject(context.engine)
+
+    def engine_for_request(self):
+        """The replica for this request, or None to use the primary."""
+        if 'db_replica' in g:
+            return g.db_replica
+
+        principal = g.get('principal')
+        engine = None
+        if request.method in READ_METHODS and principal is not None \
+                and client_of(principal) not in self.sticky:
+            engine = self.replicas.choose()
+
+        if engine is None:
+            self.primary_reads += 1
+        else:
+            self.replica_reads += 1
+        g.db_replica = engine
+        return engine
+
+    def failover(self, engine, error):
+        """Move the request off ``engine`` if ``error`` was a failed connect.
+
+        Returns False when the error is not the routed replica's. Otherwise
+        ejects it and routes the rest of the request to the next healthy
+        replica, or the primary.
+        """
+        if engine is not g.get('db_replica') or not (
+                error.connection_invalidated or
+                isinstance(error, exc.OperationalError)):
+            return False
+
+        self.replicas.eject(engine)
+        g.db_replica = self.replicas.choose()
+        if g.db_replica is None:
+            self.primary_reads += 1
+        return True
+
+    def _after_request(self, response):
+        principal = g.get('principal')
+        if request.method in WRITE_METHODS and principal is not None \
+                and response.status_code < 400:
+            self.sticky.mark(client_of(principal))
+        return response
+
+    def stats(self):
+        return {
+            'replicas': len(self.replicas.engines),
+            'healthy': len(self.replicas.healthy()),
+            'ejections': self.replicas.ejections,
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads
+        }
+
+
+def client_of(principal):
+    return principal.payload.get('sub')
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the reads of routed requests to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and has_request_context():
+            router = current_app.extensions.get('replica_router')
+            if router is not None:
+                engine = router.engine_for_request()
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper, clause)
+
+    def _connection_for_bind(self, engine, execution_options=None, **kw):
+        # A replica that cannot be reached fails here, at the checkout,
+        # before the request has read anything from it.
+        try:
+            return super()._connection_for_bind(
+                engine, execution_options, **kw)
+        except exc.DBAPIError as error:
+            router = current_app.extensions.get('replica_router') \
+                if has_request_context() else None
+            if router is None or not router.failover(engine, error):
+                raise
+        return self._connection_for_bind(
+            self.get_bind(), execution_options, **kw)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def setup_replicas(app, engine_options):
+    """Route reads to ``SQLALCHEMY_REPLICA_URLS``, if any are configured.
+
+    ``DATABASE_REPLICA_URLS`` is a comma separated list of URLs.
+    """
+    urls = os.environ.get('DATABASE_REPLICA_URLS', '')
+    app.config.setdefault('SQLALCHEMY_REPLICA_URLS',
+                          [url.strip() for url in urls.split(',')
+                           if url.strip()])
+
+    urls = app.config['SQLALCHEMY_REPLICA_URLS']
+    if not urls:
+        return None
+
+    engines = [create_engine(url, **engine_options(url)) for url in urls]
+    router = ReplicaRouter(ReplicaSet(engines), StickyClients())
+    router.init_app(app)
+    return router
@@ -0,0 +1,84 @@
+"""Ranked title/name search.
+
+On Postgres matches come from ``pg_trgm`` word similarity, served by the
+GIN trigram indexes from migration 3c9d0f6be21a, so latency grows with
+the number of matches rather than the catalog size. Other backends (the
+SQLite test database) fall back to a case-insensitive LIKE that ranks
+prefix matches above substring matches.
+"""
+from sqlalchemy import Float, case, cast, func, or_
+from sqlalchemy.orm import joinedload
+
+from database.models import db, Book, Author
+
+MAX_QUERY_LENGTH = 100
+
+
+class SearchError(ValueError):
+    pass
+
+
+def clean_query(q):
+    q = (q or '').strip()
+    if not q or len(q) > MAX_QUERY_LENGTH:
+        raise SearchError(
+            'q must be between 1 and %d characters' % MAX_QUERY_LENGTH)
+    return q
+
+
+def _uses_trigrams():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _like_score(column, q):
+    escaped = q.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+    return case(
+        (func.lower(column) == q.lower(), 1.0),
+        (column.ilike(escaped + '%', escape='!'), 0.75),
+        (column.ilike('%' + escaped + '%', escape='!'), 0.5),
+        else_=0.0
+    )
+
+
+def _score(columns, q):
+    if _uses_trigrams():
+        scores = [func.word_similarity(q, column) for column in columns]
+        score = scores[0] if len(scores) == 1 else func.greatest(*scores)
+        # word_similarity is a ``real``; as a double the score the cursor
+        # carries compares equal to the row it came from.
+        return cast(score, Float(53))
+
+    scores = [_like_score(column, q) for column in columns]
+    if len(scores) == 1:
+        return scores[0]
+    return func.max(*scores)
+
+
+def _matches(columns, q):
+    if _uses_trigrams():
+        return or_(*[column.op('%>')(q) for column in columns])
+    return _score(columns, q) > 0
+
+
+def _search(page, query, columns, q):
+    score = _score(columns, q)
+    query = query.add_columns(score.label('score')) \
+        .filter(_matches(columns, q))
+    entity = query.column_descriptions[0]['entity']
+
+    rows, next_cursor = page.apply(
+        query, score, tiebreak=entity.id, descending=True,
+        values=lambda row: [row.score, row[0].id])
+    return [row[0] for row in rows], next_cursor
+
+
+def search_books(page, q):
+    """Return (books, next_cursor) ranked by title similarity to ``q``."""
+    query = Book.query.options(joinedload(Book.author))
+    return _search(page, query, [Book.title], clean_query(q))
+
+
+def search_authors(page, q):
+    """Return (authors, next_cursor) ranked by name or full_name."""
+    return _search(page, Author.query, [Author.name, Author.full_name],
+                   clean_query(q))
@@ -0,0 +1,275 @@
+"""In-process Prometheus metrics for requests, SQL and token checks.
+
+Metrics are kept per worker process, like the ``local`` response cache:
+each gunicorn worker answers ``/metrics`` with its own counts. Recording
+is a few dict updates under a lock, cheap enough to leave enabled.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Seconds; from a cached token check up to a slow export.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', r'\\')
+                          .replace('"', r'\"').replace('\n', r'\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(tuple(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, labels=()):
+        entry = self._values.get(tuple(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = {labels: (list(counts), total)
+                      for labels, (counts, total) in self._values.items()}
+
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield (self.name + '_bucket',
+                       format_labels(self.labelnames, labels,
+                                     'le="%s"' % le), cumulative)
+            yield (self.name + '_sum',
+                   format_labels(self.labelnames, labels), total)
+            yield (self.name + '_count',
+                   format_labels(self.labelnames, labels), cumulative)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, repr(float(value))
+                                          if isinstance(value, float)
+                                          else value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+ROUTE_LABELS = ('route', 'method', 'status')
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'bookstore_http_request_duration_seconds',
+    'Time spent serving a request, including streaming its body.',
+    ROUTE_LABELS))
+SQL_QUERIES = REGISTRY.register(Counter(
+    'bookstore_sql_queries_total',
+    'SQL statements executed while serving requests.', ROUTE_LABELS))
+SQL_SECONDS = REGISTRY.register(Counter(
+    'bookstore_sql_duration_seconds_total',
+    'Time spent executing SQL statements while serving requests.',
+    ROUTE_LABELS))
+JWT_SECONDS = REGISTRY.register(Histogram(
+    'bookstore_jwt_verify_seconds',
+    'Time spent authenticating a bearer token, by result '
+    '(cached, verified or rejected).', ('result',)))
+
+
+class RequestMetrics:
+    """SQL totals of one request, filled in by the engine events.
+
+    ``statements`` maps each SQL text to ``[count, seconds]`` when the
+    query profiler asked for it, and is None otherwise.
+    """
+
+    __slots__ = ('started', 'queries', 'sql_seconds', 'statements')
+
+    def __init__(self, statements=False):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements = {} if statements else None
+
+    def record(self, statement, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        if self.statements is not None:
+            entry = self.statements.get(statement)
+            if entry is None:
+                entry = self.statements[statement] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+
+
+def current_request_metrics():
+    if not has_request_context():
+        return None
+    return g.get('request_metrics')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info['metrics_started'].pop()
+    metrics = current_request_metrics()
+    if metrics is not None:
+        metrics.record(statement, time.perf_counter() - started)
+
+
+def _handle_error(context):
+    if context.connection is not None:
+        stack = context.connection.info.get('metrics_started')
+        if stack:
+            stack.pop()
+
+
+def listen_engines():
+    """Time every statement of every engine (primary, replicas, async)."""
+    if event.contains(Engine, 'before_cursor_execute',
+                      _before_cursor_execute):
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+
+
+def track_requests(app, finish, statements=False):
+    """Collect :class:`RequestMetrics` for every request of ``app``.
+
+    ``finish(metrics, labels, response)`` is called after the view with
+    ``labels`` as (route, method, status). Streamed bodies (exports) run
+    their queries after that, so for them ``finish`` runs once the body
+    has been sent, with ``response`` None. Both the exporter and the query
+    profiler hook in here, so every statement is timed only once.
+    """
+    tracking = app.extensions.get('request_metrics')
+    if tracking is None:
+        tracking = app.extensions['request_metrics'] = {
+            'finishers': [], 'statements': False}
+        _install(app, tracking)
+
+    tracking['finishers'].append(finish)
+    tracking['statements'] = tracking['statements'] or statements
+
+
+def _install(app, tracking):
+    listen_engines()
+    finishers = tracking['finishers']
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_metrics = RequestMetrics(tracking['statements'])
+
+    @app.after_request
+    def finish_request_metrics(response):
+        metrics = g.get('request_metrics')
+        if metrics is None:
+            return response
+
+        rule = request.url_rule
+        labels = (rule.rule if rule is not None else '<unmatched>',
+                  request.method, str(response.status_code))
+
+        if response.is_streamed:
+            def finish_streamed():
+                for finish in finishers:
+                    finish(metrics, labels, None)
+            response.call_on_close(finish_streamed)
+            return response
+
+        g.pop('request_metrics')
+        for finish in finishers:
+            finish(metrics, labels, response)
+        return response
+
+
+def observe(metrics, labels, response=None):
+    REQUEST_SECONDS.observe(time.perf_counter() - metrics.started, labels)
+    SQL_QUERIES.inc(metrics.queries, labels)
+    SQL_SECONDS.inc(metrics.sql_seconds, labels)
+
+
+def setup_metrics(app):
+    """Record request metrics; returns the registry ``/metrics`` renders.
+
+    Returns None when ``METRICS_ENABLED`` is false. ``/metrics`` takes a
+    ``get:stats`` token, or ``METRICS_TOKEN`` as a static bearer token for
+    scrapers.
+    """
+    app.config.setdefault('METRICS_ENABLED', os.environ.get(
+        'METRICS_ENABLED', 'true').lower() not in ('0', 'false', 'no'))
+    app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+    if not app.config['METRICS_ENABLED']:
+        return None
+
+    track_requests(app, observe)
+    return REGISTRY
@@ -0,0 +1,125 @@
+"""Opt-in per-request SQL profiler that flags slow and N+1 requests.
+
+Every statement a request executes is timed and grouped by its SQL text.
+Bound parameters are not part of the text, so an N+1 pattern (the same
+``SELECT ... WHERE authors.id = ?`` once per book) shows up as one
+statement with a high count. A request is flagged when it runs more
+queries than its budget, takes longer than ``QUERY_PROFILER_MAX_SECONDS``
+or repeats a statement more than ``QUERY_PROFILER_MAX_REPEATS`` times.
+"""
+import json
+import logging
+import os
+import time
+
+from metrics.metrics import track_requests
+
+logger = logging.getLogger(__name__)
+
+PROFILER_MODES = ('off', 'log', 'strict')
+
+# Statements included in a report, most expensive first.
+REPORTED_STATEMENTS = 5
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised in ``strict`` mode so tests fail on a flagged request."""
+
+    def __init__(self, report):
+        super().__init__('%s %s: %s' % (report['method'], report['route'],
+                                        json.dumps(report, indent=2)))
+        self.report = report
+
+
+def report(metrics, budget, max_seconds, max_repeats):
+    """Summarize the statements of one request and flag what is wrong."""
+    seconds = time.perf_counter() - metrics.started
+    repeated = sorted(((statement, count) for statement, (count, _)
+                       in metrics.statements.items() if count > max_repeats),
+                      key=lambda item: -item[1])
+
+    flags = []
+    if budget is not None and metrics.queries > budget:
+        flags.append('query_budget')
+    if max_seconds and seconds > max_seconds:
+        flags.append('slow')
+    if repeated:
+        flags.append('repeated_statement')
+
+    top = sorted(metrics.statements.items(),
+                 key=lambda item: (-item[1][1], -item[1][0]))
+    return {
+        'queries': metrics.queries,
+        'budget': budget,
+        'sql_ms': round(metrics.sql_seconds * 1000, 3),
+        'duration_ms': round(seconds * 1000, 3),
+        'flags': flags,
+        'repeated': [{'statement': statement, 'count': count}
+                     for statement, count in repeated],
+        'statements': [{'statement': statement, 'count': count,
+                        'ms': round(total * 1000, 3)}
+                       for statement, (count, total)
+                       in top[:REPORTED_STATEMENTS]]
+    }
+
+
+def setup_profiler(app):
+    """Profile the SQL of every request when ``QUERY_PROFILER`` is set.
+
+    ``log`` writes a JSON report of each flagged request to this module's
+    logger, ``strict`` raises :class:`QueryBudgetExceeded` instead, for
+    tests. ``QUERY_BUDGETS`` maps route templates to their own query
+    budget, e.g. ``{'/books': 2}``; other routes use
+    ``QUERY_PROFILER_MAX_QUERIES``. With ``QUERY_PROFILER_HEADERS`` the
+    totals are also sent as ``X-Query-Count`` and ``Server-Timing``.
+    """
+    app.config.setdefault('QUERY_PROFILER',
+                          os.environ.get('QUERY_PROFILER', 'off'))
+    app.config.setdefault('QUERY_PROFILER_MAX_QUERIES', int(
+        os.environ.get('QUERY_PROFILER_MAX_QUERIES', 10)))
+    app.config.setdefault('QUERY_PROFILER_MAX_SECONDS', float(
+        os.environ.get('QUERY_PROFILER_MAX_SECONDS', 0.5)))
+    app.config.setdefault('QUERY_PROFILER_MAX_REPEATS', int(
+        os.environ.get('QUERY_PROFILER_MAX_REPEATS', 3)))
+    app.config.setdefault('QUERY_PROFILER_HEADERS', os.environ.get(
+        'QUERY_PROFILER_HEADERS', 'false').lower() in ('1', 'true', 'yes'))
+    app.config.setdefault('QUERY_BUDGETS', {})
+
+    mode = app.config['QUERY_PROFILER']
+    if mode not in PROFILER_MODES:
+        raise ValueError('QUERY_PROFILER must be one of %s'
+                         % ', '.join(PROFILER_MODES))
+    if mode == 'off':
+        return
+
+    def finish_query_profile(metrics, labels, response):
+        config = app.config
+        route, method, status = labels
+        profile = dict({'method': method, 'route': route,
+                        'status': int(status)}, **report(
+            metrics,
+            config['QUERY_BUDGETS'].get(
+                route, config['QUERY_PROFILER_MAX_QUERIES']),
+            config['QUERY_PROFILER_MAX_SECONDS'],
+            config['QUERY_PROFILER_MAX_REPEATS']))
+
+        if profile['flags']:
+            logger.warning('query profile %s', json.dumps(profile))
+        else:
+            logger.debug('query profile %s', json.dumps(profile))
+
+        # A streamed body has already been sent; the log is all we can do
+        if response is None:
+            return
+
+        if mode == 'strict' and profile['flags']:
+            raise QueryBudgetExceeded(profile)
+
+        if config['QUERY_PROFILER_HEADERS']:
+            response.headers['X-Query-Count'] = str(profile['queries'])
+            response.headers['Server-Timing'] = \
+                'db;dur=%.3f;desc="%d queries", app;dur=%.3f' % (
+                    profile['sql_ms'], profile['queries'],
+                    profile['duration_ms'])
+
+    track_requests(app, finish_query_profile, statements=True)
@@ -0,0 +1,45 @@
+"""add trigram search indexes
+
+Revision ID: 3c9d0f6be21a
+Revises: f5ee051c2fcf
+Create Date: 2026-10-18 11:20:03.661502
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9d0f6be21a'
+down_revision = 'f5ee051c2fcf'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_books_title_trgm', 'books', 'title'),
+    ('ix_authors_name_trgm', 'authors', 'name'),
+    ('ix_authors_full_name_trgm', 'authors', 'full_name'),
+]
+
+
+def upgrade():
+    # Search falls back to LIKE on other backends, nothing to index there.
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        for name, table, column in INDEXES:
+            op.create_index(name, table, [column], unique=False,
+                            postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'},
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, column in INDEXES:
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
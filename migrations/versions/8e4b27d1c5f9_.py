@@ -0,0 +1,27 @@
+"""add authors dob index for filtering and sorting
+
+Revision ID: 8e4b27d1c5f9
+Revises: 3c9d0f6be21a
+Create Date: 2026-10-18 11:48:36.209514
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4b27d1c5f9'
+down_revision = '3c9d0f6be21a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_authors_dob_id', 'authors', ['dob', 'id'],
+                        unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_authors_dob_id', table_name='authors',
+                      postgresql_concurrently=True)
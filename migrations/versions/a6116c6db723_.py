@@ -0,0 +1,37 @@
+"""add catalog_revisions
+
+Revision ID: a6116c6db723
+Revises: 997b33f70b27
+Create Date: 2026-10-18 09:12:41.512204
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6116c6db723'
+down_revision = '997b33f70b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    catalog_revisions = op.create_table('catalog_revisions',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('revision', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    # Seed the rows so writers only ever UPDATE them.
+    now = datetime.utcnow()
+    op.bulk_insert(catalog_revisions, [
+        {'table_name': 'authors', 'revision': 1, 'updated_at': now},
+        {'table_name': 'books', 'revision': 1, 'updated_at': now}
+    ])
+
+
+def downgrade():
+    op.drop_table('catalog_revisions')
@@ -0,0 +1,51 @@
+"""order the change feed by commit revision
+
+Revision ID: b2d7e94a1c03
+Revises: 8e4b27d1c5f9
+Create Date: 2026-10-18 19:20:41.530217
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d7e94a1c03'
+down_revision = '8e4b27d1c5f9'
+branch_labels = None
+depends_on = None
+
+TABLES = ['authors', 'books', 'tombstones']
+
+
+def upgrade():
+    # Existing rows get revision 0, which the first sync still reads.
+    for table in TABLES:
+        op.add_column(table, sa.Column('revision', sa.Integer(),
+                      nullable=False, server_default='0'))
+        op.create_index('ix_%s_revision_id' % table, table,
+                        ['revision', 'id'], unique=False)
+    op.drop_index('ix_books_updated_at_id', table_name='books')
+    op.drop_index('ix_authors_updated_at_id', table_name='authors')
+
+    # Created up front so concurrent first writers only ever update it.
+    catalog_revisions = sa.table(
+        'catalog_revisions', sa.column('table_name', sa.String),
+        sa.column('revision', sa.Integer),
+        sa.column('updated_at', sa.DateTime))
+    op.bulk_insert(catalog_revisions, [{
+        'table_name': 'changes', 'revision': 0,
+        'updated_at': datetime.utcnow()}])
+
+
+def downgrade():
+    op.execute("DELETE FROM catalog_revisions WHERE table_name = 'changes'")
+    op.create_index('ix_authors_updated_at_id', 'authors',
+                    ['updated_at', 'id'], unique=False)
+    op.create_index('ix_books_updated_at_id', 'books',
+                    ['updated_at', 'id'], unique=False)
+    for table in reversed(TABLES):
+        op.drop_index('ix_%s_revision_id' % table, table_name=table)
+        op.drop_column(table, 'revision')
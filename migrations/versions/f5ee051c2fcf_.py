@@ -0,0 +1,38 @@
+"""add indexes for author, title, name and release_date lookups
+
+Revision ID: f5ee051c2fcf
+Revises: f71f3d5aa77e
+Create Date: 2026-10-18 10:41:55.730118
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5ee051c2fcf'
+down_revision = 'f71f3d5aa77e'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_books_author_id', 'books', ['author_id']),
+    ('ix_books_title', 'books', ['title']),
+    ('ix_books_release_date_id', 'books', ['release_date', 'id']),
+    ('ix_authors_name', 'authors', ['name']),
+]
+
+
+def upgrade():
+    # CONCURRENTLY keeps the tables writable while Postgres builds the
+    # indexes; it cannot run inside the migration transaction.
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
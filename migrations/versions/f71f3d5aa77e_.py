@@ -0,0 +1,45 @@
+"""add updated_at change tracking and tombstones
+
+Revision ID: f71f3d5aa77e
+Revises: a6116c6db723
+Create Date: 2026-10-18 10:02:17.084391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f71f3d5aa77e'
+down_revision = 'a6116c6db723'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows are stamped with the migration time so the first
+    # incremental sync still sees them.
+    op.add_column('authors', sa.Column('updated_at', sa.DateTime(),
+                  nullable=False, server_default=sa.func.now()))
+    op.add_column('books', sa.Column('updated_at', sa.DateTime(),
+                  nullable=False, server_default=sa.func.now()))
+    op.create_index('ix_authors_updated_at_id', 'authors',
+                    ['updated_at', 'id'], unique=False)
+    op.create_index('ix_books_updated_at_id', 'books',
+                    ['updated_at', 'id'], unique=False)
+
+    op.create_table('tombstones',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('tombstones')
+    op.drop_index('ix_books_updated_at_id', table_name='books')
+    op.drop_index('ix_authors_updated_at_id', table_name='authors')
+    op.drop_column('books', 'updated_at')
+    op.drop_column('authors', 'updated_at')
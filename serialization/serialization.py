@@ -0,0 +1,114 @@
+import os
+from datetime import date
+from functools import lru_cache
+
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider that encodes with orjson when it is installed.
+
+    Output decodes to the same documents as Flask's default provider: keys
+    are sorted and dates are written as HTTP dates (non-ASCII text is sent
+    as UTF-8 rather than escaped). With ``date_format = 'iso'`` dates
+    are encoded natively by orjson as ``YYYY-MM-DD`` instead, which skips
+    the per-value Python callback. Without orjson, or for arguments orjson
+    does not understand, the stdlib encoder is used.
+    """
+
+    use_orjson = orjson is not None
+    date_format = 'http'
+
+    def _orjson_options(self):
+        options = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if self.date_format != 'iso':
+            options |= orjson.OPT_PASSTHROUGH_DATETIME
+        return options
+
+    @staticmethod
+    def default(o):
+        # Catalogs repeat a small set of dates, so the formatted value is
+        # reused instead of rebuilt for every row.
+        if isinstance(o, date):
+            return cached_http_date(o)
+        return DefaultJSONProvider.default(o)
+
+    def _dumpb(self, obj):
+        """Encode ``obj`` to bytes, or return None to use the stdlib."""
+        if not self.use_orjson:
+            return None
+
+        try:
+            return orjson.dumps(obj, default=self.default,
+                                option=self._orjson_options())
+        except TypeError:
+            # Integers beyond 64 bits and the like
+            return None
+
+    def dumps(self, obj, **kwargs):
+        if not kwargs:
+            encoded = self._dumpb(obj)
+            if encoded is not None:
+                return encoded.decode()
+
+        if self.date_format == 'iso':
+            kwargs.setdefault('default', iso_default)
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if self.use_orjson and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if self._app.debug and self.compact is None:
+            # Pretty printing is only available from the stdlib encoder
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        encoded = self._dumpb(obj)
+        if encoded is None:
+            return super().response(*args, **kwargs)
+
+        return self._app.response_class(encoded + b'\n',
+                                        mimetype=self.mimetype)
+
+
+@lru_cache(maxsize=4096)
+def cached_http_date(value):
+    return http_date(value)
+
+
+def iso_default(o):
+    if hasattr(o, 'isoformat'):
+        return o.isoformat()
+    return DefaultJSONProvider.default(o)
+
+
+def setup_json(app):
+    """Install the JSON provider configured by ``JSON_ENCODER``.
+
+    ``orjson`` (default) uses orjson when it is importable, ``stdlib``
+    always uses the json module. ``JSON_DATE_FORMAT`` is ``http``
+    (default, the Flask format) or ``iso``.
+    """
+    app.config.setdefault('JSON_ENCODER_BACKEND',
+                          os.environ.get('JSON_ENCODER', 'orjson'))
+    app.config.setdefault('JSON_DATE_FORMAT',
+                          os.environ.get('JSON_DATE_FORMAT', 'http'))
+
+    provider = FastJSONProvider(app)
+    provider.use_orjson = orjson is not None and \
+        app.config['JSON_ENCODER_BACKEND'] == 'orjson'
+    provider.date_format = app.config['JSON_DATE_FORMAT']
+
+    app.json = provider
+    return provider
@@ -0,0 +1,1491 @@
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+from datetime import date, datetime, timedelta
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bookstore.test')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bookstore-test')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import sqlalchemy.exc
+from flask import jsonify
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import postgresql
+
+from app import create_app
+from auth import auth
+from auth.jwks import JWKSKeyStore
+from auth.testing import LocalSigner
+from database.models import db, Book, Author, bump_revision
+from database.changes import encode_token, initial_position
+from database import search
+from database.pagination import DEFAULT_PAGE_SIZE, encode_cursor, \
+    segments
+from database.replicas import REPLICA_EJECT_SECONDS
+from database.pool import engine_options, queue_pool_options, \
+    pool_stats, MonitoredQueuePool, DB_POOL_SIZE
+from cache.testing import FakeRedis
+from benchmarks.suite import uncovered_routes
+from metrics.metrics import REQUEST_SECONDS, SQL_QUERIES, JWT_SECONDS
+from metrics.profiler import QueryBudgetExceeded
+
+ALL_PERMISSIONS = [
+    'get:books', 'get:authors', 'get:books_by_author', 'get:books_detail',
+    'get:authors_detail', 'post:books', 'post:authors', 'patch:books',
+    'patch:authors', 'delete:books', 'delete:authors', 'get:stats',
+    'get:all'
+]
+
+
+class ApiTestCase(unittest.TestCase):
+    """Runs the app against in-memory SQLite with locally signed tokens"""
+
+    config = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.signer = LocalSigner(auth.AUTH0_DOMAIN, auth.API_AUDIENCE)
+        cls._saved_store = auth.jwks_store
+        auth.jwks_store = JWKSKeyStore(cls.signer.jwks_url)
+        auth.jwks_store.add_listener(auth.token_cache.evict_kids)
+
+        cls.headers = {
+            "Authorization": "Bearer " + cls.signer.token(ALL_PERMISSIONS)
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        auth.jwks_store = cls._saved_store
+        auth.token_cache.clear()
+        cls.signer.close()
+
+    def setUp(self):
+        self.app = create_app(dict({
+            "SQLALCHEMY_DATABASE_URI": "sqlite://",
+            "TESTING": True,
+            "CACHE_TYPE": "none",
+            # Every request below must stay within its query budget
+            "QUERY_PROFILER": "strict",
+            "QUERY_PROFILER_MAX_SECONDS": 0
+        }, **self.config))
+        self.client = self.app.test_client
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        self.statements.append(statement)
+
+    def seed(self, authors=2, books_per_author=2):
+        for i in range(authors):
+            author = Author('author%d' % i, 'Author %d' % i, date(1970, 1, 1))
+            db.session.add(author)
+            db.session.flush()
+            for j in range(books_per_author):
+                db.session.add(Book('book%d-%d' % (i, j), 'desc',
+                                    date(2020, 1, 1), author.id))
+        bump_revision('authors', 'books')
+        db.session.commit()
+        db.session.expunge_all()
+
+    def count_queries(self, method, url, **kwargs):
+        self.statements = []
+        res = getattr(self.client(), method)(url, headers=self.headers,
+                                             **kwargs)
+        return res, len(self.statements)
+
+
+class QueryCountTest(ApiTestCase):
+    """Read endpoints run a fixed number of queries"""
+
+    def test_get_books_query_count_is_constant(self):
+        self.seed(authors=2, books_per_author=2)
+        res, small = self.count_queries('get', '/books?all=true')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.get_json()['books']), 4)
+
+        self.seed(authors=20, books_per_author=5)
+        res, large = self.count_queries('get', '/books?all=true')
+        self.assertEqual(len(res.get_json()['books']), 104)
+
+        self.assertEqual(small, large)
+        self.assertEqual(res.get_json()['books'][0]['author'], 'author0')
+
+    def test_get_books_by_author_query_count_is_constant(self):
+        self.seed(authors=1, books_per_author=2)
+        _, small = self.count_queries('get', '/books/author/1')
+
+        self.seed(authors=1, books_per_author=50)
+        res, large = self.count_queries('get', '/books/author/2')
+        self.assertEqual(len(res.get_json()['books']), 50)
+
+        self.assertEqual(small, large)
+
+    def test_get_book_detail_loads_author_in_one_query(self):
+        self.seed(authors=1, books_per_author=1)
+        res, count = self.count_queries('get', '/books/1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['books'][0]['author'], 'author0')
+        # catalog revision lookup + book joined with its author
+        self.assertEqual(count, 2)
+
+
+class AuthorBookCountTest(ApiTestCase):
+    """number_of_books is computed with COUNT instead of loading books"""
+
+    def test_author_detail_counts_in_sql(self):
+        self.seed(authors=1, books_per_author=1)
+        _, small = self.count_queries('get', '/authors/1')
+
+        self.seed(authors=1, books_per_author=100)
+        res, large = self.count_queries('get', '/authors/2')
+
+        self.assertEqual(res.get_json()['authors'][0]['number_of_books'], 100)
+        self.assertEqual(small, large)
+        self.assertFalse(any(s.lstrip().startswith('SELECT books.id AS')
+                             for s in self.statements))
+
+    def test_long_many_uses_one_grouped_count(self):
+        self.seed(authors=3, books_per_author=2)
+        db.session.add(Author('lonely', 'Lonely', date(1970, 1, 1)))
+        db.session.commit()
+
+        authors = Author.query.order_by(Author.id).all()
+        self.statements = []
+        data = Author.long_many(authors)
+
+        self.assertEqual([a['number_of_books'] for a in data], [2, 2, 2, 0])
+        self.assertEqual(len(self.statements), 1)
+
+
+class PaginationTest(ApiTestCase):
+    """List endpoints page with an opaque keyset cursor"""
+
+    def walk(self, url):
+        ids, cursor, pages = [], None, 0
+        while True:
+            page_url = url if cursor is None else url + '&cursor=' + cursor
+            data = self.client().get(page_url, headers=self.headers) \
+                .get_json()
+            ids.extend(item['id'] for item in data[self.key])
+            pages += 1
+            cursor = data['next_cursor']
+            if cursor is None:
+                return ids, pages
+
+    def test_walks_every_book_once(self):
+        self.seed(authors=3, books_per_author=4)
+        self.key = 'books'
+
+        ids, pages = self.walk('/books?limit=5')
+
+        self.assertEqual(ids, list(range(1, 13)))
+        self.assertEqual(pages, 3)
+
+    def test_walks_books_by_author(self):
+        self.seed(authors=2, books_per_author=3)
+        self.key = 'books'
+
+        ids, pages = self.walk('/books/author/2?limit=2')
+
+        self.assertEqual(ids, [4, 5, 6])
+        self.assertEqual(pages, 2)
+
+    def test_default_page_size_is_bounded(self):
+        self.seed(authors=3, books_per_author=50)
+
+        data = self.client().get('/books', headers=self.headers).get_json()
+
+        self.assertEqual(len(data['books']), DEFAULT_PAGE_SIZE)
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_all_opts_out_of_paging(self):
+        self.seed(authors=3, books_per_author=50)
+
+        res = self.client().get('/books?all=true', headers=self.headers)
+        data = res.get_json()
+
+        self.assertEqual(len(data['books']), 150)
+        self.assertIsNone(data['next_cursor'])
+
+    def test_rejects_bad_arguments(self):
+        for query in ('limit=0', 'limit=abc', 'limit=100000',
+                      'cursor=not-a-cursor',
+                      'cursor=' + encode_cursor(10 ** 25),
+                      'sort=dob&cursor=' + encode_cursor(None, -10 ** 25)):
+            res = self.client().get('/authors?' + query, headers=self.headers)
+            self.assertEqual(res.status_code, 400, query)
+
+
+class FilterSortTest(ApiTestCase):
+    """List filters and sort keys are validated and run in SQL"""
+
+    def setUp(self):
+        super().setUp()
+        for name, dob in (('carol', date(1980, 5, 1)), ('alice', None),
+                          ('bob', date(1960, 2, 1))):
+            db.session.add(Author(name, name.title(), dob))
+        db.session.flush()
+        for title, released, author_id in (
+                ('b', date(2020, 3, 1), 1), ('d', date(2021, 6, 1), 2),
+                ('a', None, 1), ('c', date(2020, 3, 1), 3),
+                ('e', date(2019, 1, 1), 2)):
+            db.session.add(Book(title, 'desc', released, author_id))
+        db.session.commit()
+
+    def get(self, url):
+        res = self.client().get(url, headers=self.headers)
+        self.assertEqual(res.status_code, 200, url)
+        return res.get_json()
+
+    def walk(self, url):
+        ids, cursor = [], None
+        while True:
+            data = self.get(url if cursor is None
+                            else url + '&cursor=' + cursor)
+            ids.extend(book['id'] for book in data['books'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return ids
+
+    def test_filters_books_by_date_range_and_author(self):
+        data = self.get('/books?released_after=2020/01/01'
+                        '&released_before=2020-12-31')
+        self.assertEqual([b['title'] for b in data['books']], ['b', 'c'])
+
+        data = self.get('/books?author_id=2&released_after=2020/01/01')
+        self.assertEqual([b['title'] for b in data['books']], ['d'])
+
+    def test_filters_authors_by_dob(self):
+        data = self.get('/authors?born_after=1970/01/01')
+        self.assertEqual([a['name'] for a in data['authors']], ['carol'])
+
+    def test_sorts_in_both_directions(self):
+        data = self.get('/books?sort=title&order=desc')
+        self.assertEqual([b['title'] for b in data['books']],
+                         ['e', 'd', 'c', 'b', 'a'])
+
+        data = self.get('/authors?sort=name')
+        self.assertEqual([a['name'] for a in data['authors']],
+                         ['alice', 'bob', 'carol'])
+
+    def test_paging_a_nullable_sort_key(self):
+        # Equal dates page by id and the NULL date sorts last
+        self.assertEqual(
+            self.walk('/books?sort=release_date&limit=1'),
+            [5, 1, 4, 2, 3])
+        self.assertEqual(
+            self.walk('/books?sort=release_date&order=desc&limit=2'),
+            [3, 2, 4, 1, 5])
+
+    def test_paging_through_several_null_keys(self):
+        db.session.add(Book('f', 'desc', None, 2))
+        db.session.commit()
+
+        self.assertEqual(
+            self.walk('/books?sort=release_date&limit=1'),
+            [5, 1, 4, 2, 3, 6])
+        self.assertEqual(
+            self.walk('/books?sort=release_date&order=desc&limit=2'),
+            [6, 3, 2, 4, 1, 5])
+        self.assertEqual(
+            self.walk('/books?sort=release_date&order=desc&limit=1'),
+            [6, 3, 2, 4, 1, 5])
+
+    def test_books_by_author_use_the_same_listing(self):
+        data = self.get('/books/author/1?sort=title&order=desc')
+        self.assertEqual([b['title'] for b in data['books']], ['b', 'a'])
+
+        data = self.get('/books/author/2?released_after=2020/01/01')
+        self.assertEqual([b['title'] for b in data['books']], ['d'])
+
+        for query in ('sort=description', 'order=up', 'author_id=2',
+                      'title=a'):
+            res = self.client().get('/books/author/1?' + query,
+                                    headers=self.headers)
+            self.assertEqual(res.status_code, 400, query)
+
+    def test_rejects_unknown_or_invalid_parameters(self):
+        for query in ('sort=description', 'order=up', 'title=a',
+                      'released_after=yesterday', 'author_id=x',
+                      'author_id=0', 'author_id=%d' % 10 ** 23):
+            res = self.client().get('/books?' + query, headers=self.headers)
+            self.assertEqual(res.status_code, 400, query)
+
+        res = self.client().get('/authors?author_id=1', headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class SparseFieldsetTest(ApiTestCase):
+    """fields= narrows the SELECT and include= embeds in one more query"""
+
+    def get(self, url):
+        res, queries = self.count_queries('get', url)
+        self.assertEqual(res.status_code, 200, url)
+        return res.get_json(), queries
+
+    def test_default_rows_match_short(self):
+        self.seed(authors=2, books_per_author=2)
+        db.session.add(Book('orphan', 'desc', None, None))
+        db.session.commit()
+
+        books, _ = self.get('/books')
+        authors, _ = self.get('/authors')
+        by_author, _ = self.get('/books/author/2')
+
+        self.assertEqual(books['books'],
+                         [book.short() for book in Book.query])
+        self.assertEqual(books['books'][-1]['author'], 'Not have author')
+        self.assertEqual(authors['authors'],
+                         [author.short() for author in Author.query])
+        self.assertEqual(by_author['books'], [
+            book.short() for book in Book.query.filter_by(author_id=2)])
+
+    def test_fields_select_only_those_columns(self):
+        self.seed(authors=2, books_per_author=2)
+
+        data, _ = self.get('/books?fields=title,release_date')
+
+        self.assertEqual(data['books'][0], {
+            'id': 1,
+            'title': 'book0-0',
+            'release_date': 'Wed, 01 Jan 2020 00:00:00 GMT'
+        })
+        select = [s for s in self.statements if 'FROM books' in s][0]
+        self.assertNotIn('description', select)
+        self.assertNotIn('authors', select)
+
+    def test_fields_page_by_an_unselected_sort_key(self):
+        self.seed(authors=1, books_per_author=5)
+
+        data, _ = self.get('/books?fields=id&sort=title&limit=3')
+        self.assertEqual(data['books'], [{'id': 1}, {'id': 2}, {'id': 3}])
+
+        data, _ = self.get('/books?fields=id&sort=title&limit=3&cursor='
+                           + data['next_cursor'])
+        self.assertEqual(data['books'], [{'id': 4}, {'id': 5}])
+
+    def test_include_author_is_one_batched_query(self):
+        self.seed(authors=2, books_per_author=2)
+        _, few = self.get('/books?include=author&all=true')
+
+        self.seed(authors=20, books_per_author=5)
+        data, many = self.get('/books?include=author&all=true')
+
+        # revisions + books + authors
+        self.assertEqual(few, 3)
+        self.assertEqual(many, few)
+        self.assertEqual(data['books'][0], {
+            'id': 1,
+            'title': 'book0-0',
+            'author': {'id': 1, 'name': 'author0', 'full_name': 'Author 0',
+                       'dob': 'Thu, 01 Jan 1970 00:00:00 GMT'}
+        })
+
+    def test_include_books_on_authors(self):
+        self.seed(authors=2, books_per_author=2)
+        db.session.add(Author('lonely', 'Lonely', date(1970, 1, 1)))
+        db.session.commit()
+
+        data, queries = self.get('/authors?fields=name&include=books')
+
+        self.assertEqual(queries, 3)
+        self.assertEqual(
+            [[book['title'] for book in author['books']]
+             for author in data['authors']],
+            [['book0-0', 'book0-1'], ['book1-0', 'book1-1'], []])
+        self.assertEqual(set(data['authors'][0]),
+                         {'id', 'name', 'books', 'books_truncated'})
+        self.assertFalse(data['authors'][0]['books_truncated'])
+
+    def test_include_books_is_capped_per_author(self):
+        self.seed(authors=2, books_per_author=3)
+
+        with unittest.mock.patch('database.fieldsets.INCLUDE_MAX_ITEMS', 2):
+            data, queries = self.get('/authors?include=books')
+
+        self.assertEqual(queries, 3)
+        self.assertEqual(
+            [[book['title'] for book in author['books']]
+             for author in data['authors']],
+            [['book0-0', 'book0-1'], ['book1-0', 'book1-1']])
+        self.assertEqual([author['books_truncated']
+                          for author in data['authors']], [True, True])
+
+    def test_rejects_unknown_fields_and_includes(self):
+        for url in ('/books?fields=price', '/books?include=books',
+                    '/authors?fields=title', '/authors?fields=name,,id'):
+            res = self.client().get(url, headers=self.headers)
+            self.assertEqual(res.status_code, 400, url)
+
+
+class JSONProviderTest(ApiTestCase):
+    """The fast encoder returns the same documents as the stdlib one"""
+
+    url = '/books?fields=title,description,release_date,author&all=true'
+
+    def fetch(self, use_orjson, date_format='http'):
+        self.app.json.use_orjson = use_orjson
+        self.app.json.date_format = date_format
+        res = self.client().get(self.url, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/json')
+        return res
+
+    def test_backends_agree(self):
+        self.seed(authors=2, books_per_author=2)
+
+        fast = self.fetch(use_orjson=True)
+        slow = self.fetch(use_orjson=False)
+
+        self.assertEqual(json.loads(fast.data), json.loads(slow.data))
+        self.assertEqual(fast.get_json()['books'][0]['release_date'],
+                         'Wed, 01 Jan 2020 00:00:00 GMT')
+
+    def test_iso_dates(self):
+        self.seed(authors=1, books_per_author=1)
+
+        for use_orjson in (True, False):
+            res = self.fetch(use_orjson, date_format='iso')
+            self.assertEqual(res.get_json()['books'][0]['release_date'],
+                             '2020-01-01')
+
+    def test_falls_back_for_values_orjson_rejects(self):
+        with self.app.test_request_context():
+            self.assertEqual(json.loads(self.app.json.dumps({'n': 2 ** 70})),
+                             {'n': 2 ** 70})
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Pool settings come from the environment and usage is counted"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///' + os.path.join(self.directory.name, 'db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_options_for_server_databases(self):
+        options = engine_options('postgresql://localhost/bookstore')
+
+        self.assertIs(options['poolclass'], MonitoredQueuePool)
+        self.assertEqual(options['pool_size'], DB_POOL_SIZE)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(engine_options('sqlite://'), {})
+
+    def test_counts_checkouts_overflow_and_timeouts(self):
+        engine = create_engine(self.url, **queue_pool_options(
+            pool_size=1, max_overflow=1, pool_timeout=0.05,
+            pool_pre_ping=False))
+
+        first, second = engine.connect(), engine.connect()
+        stats = pool_stats(engine)
+        self.assertEqual(stats['checked_out'], 2)
+        self.assertEqual(stats['overflow'], 1)
+
+        with self.assertRaises(sqlalchemy.exc.TimeoutError):
+            engine.connect()
+
+        first.close()
+        second.close()
+        stats = pool_stats(engine)
+        self.assertEqual(stats['pool'], 'MonitoredQueuePool')
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['wait_seconds_max'], 0.05)
+
+        engine.dispose()
+        self.assertEqual(pool_stats(engine)['timeouts'], 1)
+
+
+class ReplicaRoutingTest(ApiTestCase):
+    """Authenticated GETs read from replicas, writes stay on the primary"""
+
+    cache = {}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = dict({
+            'SQLALCHEMY_DATABASE_URI': self.database('primary'),
+            'SQLALCHEMY_REPLICA_URLS': [
+                self.database('missing/replica'), self.database('replica')
+            ]
+        }, **self.cache)
+        super().setUp()
+
+        self.router = self.app.extensions['replica_router']
+        self.replica = self.router.replicas.engines[1]
+        db.Model.metadata.create_all(self.replica)
+
+        db.session.add(Author('primary', 'Primary', date(1970, 1, 1)))
+        bump_revision('authors')
+        db.session.commit()
+        with self.replica.begin() as connection:
+            connection.execute(Author.__table__.insert(), {
+                'name': 'replica', 'full_name': 'Replica'})
+
+        # The first read tries the unreachable replica, ejects it and
+        # falls through to the healthy one
+        self.assertEqual(self.names(), ['replica'])
+
+    def tearDown(self):
+        super().tearDown()
+        for engine in self.router.replicas.engines:
+            engine.dispose()
+        self.directory.cleanup()
+
+    def database(self, name):
+        return 'sqlite:///' + os.path.join(self.directory.name, name)
+
+    def names(self):
+        res = self.client().get('/authors', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return [author['name'] for author in res.get_json()['authors']]
+
+    def test_reads_go_to_healthy_replicas(self):
+        self.assertEqual(self.names(), ['replica'])
+        self.assertEqual(self.names(), ['replica'])
+
+        stats = self.client().get('/db/replicas/stats',
+                                  headers=self.headers).get_json()
+        self.assertEqual(stats['healthy'], 1)
+        self.assertEqual(stats['ejections'], 1)
+
+    def test_writer_reads_its_writes_from_the_primary(self):
+        res = self.client().post('/authors', headers=self.headers, json={
+            'name': 'new', 'full_name': 'New', 'dob': '1980/01/01'})
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(self.names(), ['primary', 'new'])
+
+        other = {'Authorization': 'Bearer ' + self.signer.token(
+            ALL_PERMISSIONS, sub='someone-else')}
+        # A URL the writer's primary read has not cached
+        res = self.client().get('/authors?limit=10', headers=other)
+        self.assertEqual(len(res.get_json()['authors']), 1)
+
+        self.router.sticky.window = 0
+        self.client().post('/authors', headers=self.headers, json={
+            'name': 'later', 'full_name': 'Later', 'dob': '1980/01/01'})
+        self.assertEqual(self.names(), ['replica'])
+
+    def test_a_read_checks_out_the_replica_once(self):
+        # Release what the session kept from setUp's read
+        db.session.remove()
+        checkouts = []
+        event.listen(self.replica, 'checkout',
+                     lambda *args: checkouts.append(1))
+
+        self.assertEqual(self.names(), ['replica'])
+        self.assertEqual(len(checkouts), 1)
+
+    def test_reads_fall_back_to_the_primary_when_no_replica_connects(self):
+        self.router.replicas.engines[1] = create_engine(
+            self.database('missing/other'))
+
+        self.assertEqual(self.names(), ['primary'])
+        self.assertEqual(self.router.replicas.healthy(), [])
+        self.assertEqual(self.router.replicas.ejections, 2)
+
+    def test_ejected_replica_comes_back(self):
+        later = self.router.replicas.clock() + REPLICA_EJECT_SECONDS + 1
+        self.router.replicas.clock = lambda: later
+
+        self.assertEqual(len(self.router.replicas.healthy()), 2)
+
+    def test_writer_never_gets_a_lagging_replica_body(self):
+        res = self.client().patch('/authors/1', headers=self.headers,
+                                  json={'name': 'new'})
+        self.assertEqual(res.status_code, 200)
+
+        other = {'Authorization': 'Bearer ' + self.signer.token(
+            ALL_PERMISSIONS, sub='someone-else')}
+        for _ in range(2):
+            res = self.client().get('/authors/1', headers=other)
+            self.assertEqual(res.get_json()['authors'][0]['name'],
+                             'replica')
+
+        res = self.client().get('/authors/1', headers=self.headers)
+        self.assertEqual(res.get_json()['authors'][0]['name'], 'new')
+        res = self.client().get('/authors/1', headers=dict(
+            self.headers, **{'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+
+class CachedReplicaRoutingTest(ReplicaRoutingTest):
+
+    cache = {'CACHE_TYPE': 'local'}
+
+
+class SharedCachedReplicaRoutingTest(ReplicaRoutingTest):
+
+    def setUp(self):
+        self.cache = {'CACHE_TYPE': 'redis', 'CACHE_CLIENT': FakeRedis()}
+        super().setUp()
+
+    def test_writer_reads_its_writes_on_another_worker(self):
+        other_worker = create_app(self.config)
+        self.addCleanup(lambda: [
+            engine.dispose() for engine
+            in other_worker.extensions['replica_router'].replicas.engines])
+
+        res = self.client().post('/authors', headers=self.headers, json={
+            'name': 'new', 'full_name': 'New', 'dob': '1980/01/01'})
+        self.assertEqual(res.status_code, 200)
+
+        res = other_worker.test_client().get('/authors?limit=5',
+                                             headers=self.headers)
+        self.assertEqual([author['name'] for author
+                          in res.get_json()['authors']], ['primary', 'new'])
+
+
+def add_lazy_authors_route(app):
+    @app.route('/lazy-authors')
+    def lazy_authors():
+        # The pattern the fieldset read path replaced in Book.short()
+        return jsonify([book.author.name for book in Book.query.all()])
+
+
+class QueryProfilerTest(ApiTestCase):
+    """Requests over their query budget or with N+1 patterns are flagged"""
+
+    config = {'QUERY_BUDGETS': {'/books/<int:book_id>': 1}}
+
+    def setUp(self):
+        super().setUp()
+        add_lazy_authors_route(self.app)
+
+    def test_repeated_statement_fails_in_strict_mode(self):
+        self.seed(authors=5, books_per_author=1)
+
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            self.client().get('/lazy-authors')
+
+        report = raised.exception.report
+        self.assertEqual(report['route'], '/lazy-authors')
+        self.assertEqual(report['flags'], ['repeated_statement'])
+        self.assertEqual(report['queries'], 6)
+        self.assertEqual(report['repeated'][0]['count'], 5)
+        self.assertIn('FROM authors', report['repeated'][0]['statement'])
+
+    def test_route_budget_fails_in_strict_mode(self):
+        self.seed(authors=1, books_per_author=1)
+
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            self.client().get('/books/1', headers=self.headers)
+
+        self.assertEqual(raised.exception.report['flags'], ['query_budget'])
+        self.assertEqual(raised.exception.report['budget'], 1)
+        self.assertEqual(raised.exception.report['queries'], 2)
+
+
+class QueryProfilerLogTest(ApiTestCase):
+
+    config = {'QUERY_PROFILER': 'log', 'QUERY_PROFILER_HEADERS': True}
+
+    def setUp(self):
+        super().setUp()
+        add_lazy_authors_route(self.app)
+
+    def test_flagged_requests_are_logged(self):
+        self.seed(authors=5, books_per_author=1)
+
+        with self.assertLogs('metrics.profiler', 'WARNING') as logs:
+            res = self.client().get('/lazy-authors')
+        self.assertEqual(res.status_code, 200)
+
+        report = json.loads(logs.records[0].getMessage().split(' ', 2)[2])
+        self.assertEqual(report['flags'], ['repeated_statement'])
+        self.assertEqual(report['queries'], 6)
+
+    def test_totals_are_sent_as_headers(self):
+        self.seed(authors=2, books_per_author=2)
+
+        res, count = self.count_queries('get', '/books?all=true')
+        self.assertEqual(res.headers['X-Query-Count'], str(count))
+        self.assertTrue(res.headers['Server-Timing'].startswith('db;dur='))
+
+
+class MetricsTest(ApiTestCase):
+    """Requests, their SQL and token checks are exported on /metrics"""
+
+    labels = ('/books', 'GET', '200')
+
+    def test_counts_requests_and_queries_per_route(self):
+        self.seed(authors=2, books_per_author=2)
+        requests = REQUEST_SECONDS.count(self.labels)
+        queries = SQL_QUERIES.value(self.labels)
+
+        res, first = self.count_queries('get', '/books')
+        self.assertEqual(res.status_code, 200)
+        res, second = self.count_queries('get', '/books?limit=1')
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(REQUEST_SECONDS.count(self.labels), requests + 2)
+        self.assertEqual(SQL_QUERIES.value(self.labels),
+                         queries + first + second)
+
+        text = self.client().get('/metrics',
+                                 headers=self.headers).data.decode()
+        self.assertIn('# TYPE bookstore_http_request_duration_seconds '
+                      'histogram', text)
+        self.assertIn('bookstore_http_request_duration_seconds_count'
+                      '{route="/books",method="GET",status="200"} %d'
+                      % REQUEST_SECONDS.count(self.labels), text)
+        self.assertIn('bookstore_sql_queries_total{route="/books",'
+                      'method="GET",status="200"} %d'
+                      % SQL_QUERIES.value(self.labels), text)
+
+    def test_labels_use_the_route_template(self):
+        labels = ('/books/<int:book_id>', 'GET', '404')
+        requests = REQUEST_SECONDS.count(labels)
+
+        self.client().get('/books/12345', headers=self.headers)
+        self.client().get('/books/54321', headers=self.headers)
+
+        self.assertEqual(REQUEST_SECONDS.count(labels), requests + 2)
+
+    def test_streamed_queries_are_counted_after_the_body(self):
+        self.seed(authors=1, books_per_author=3)
+        labels = ('/books/export', 'GET', '200')
+        queries = SQL_QUERIES.value(labels)
+
+        res = self.client().get('/books/export', headers=self.headers)
+        self.assertEqual(len(res.data.splitlines()), 3)
+        res.close()
+
+        self.assertGreater(SQL_QUERIES.value(labels), queries)
+
+    def test_times_token_checks_by_result(self):
+        before = {result: JWT_SECONDS.count((result,))
+                  for result in ('cached', 'verified', 'rejected')}
+        auth.token_cache.clear()
+
+        self.client().get('/books', headers=self.headers)
+        self.client().get('/books', headers=self.headers)
+        self.client().get('/books', headers={
+            'Authorization': 'Bearer not-a-token'})
+
+        for result in ('cached', 'verified', 'rejected'):
+            self.assertEqual(JWT_SECONDS.count((result,)),
+                             before[result] + 1, result)
+
+
+class MetricsAuthTest(ApiTestCase):
+    """/metrics takes a get:stats token or the static METRICS_TOKEN"""
+
+    config = {'METRICS_TOKEN': 'scrape-secret'}
+
+    def scrape(self, token=None):
+        headers = {} if token is None else {
+            'Authorization': 'Bearer ' + token}
+        return self.client().get('/metrics', headers=headers).status_code
+
+    def test_requires_stats_permission_or_metrics_token(self):
+        self.assertEqual(self.scrape(), 401)
+        self.assertEqual(self.scrape(self.signer.token(['get:books'])), 403)
+        self.assertEqual(self.scrape(self.signer.token(['get:stats'])), 200)
+        self.assertEqual(self.scrape('scrape-secret'), 200)
+        self.assertNotEqual(self.scrape('scrape-secreT'), 200)
+
+
+class DisabledMetricsTest(ApiTestCase):
+
+    config = {'METRICS_ENABLED': False}
+
+    def test_endpoint_is_off(self):
+        requests = REQUEST_SECONDS.count(('/books', 'GET', '200'))
+
+        self.assertEqual(self.client().get('/books',
+                                           headers=self.headers).status_code,
+                         200)
+        self.assertEqual(self.client().get('/metrics').status_code, 404)
+        self.assertEqual(REQUEST_SECONDS.count(('/books', 'GET', '200')),
+                         requests)
+
+
+class StatsAuthTest(ApiTestCase):
+
+    def test_internal_counters_require_the_stats_permission(self):
+        reader = {"Authorization": "Bearer " + self.signer.token(
+            ['get:books'])}
+
+        for url in ('/cache/stats', '/db/pool/stats', '/db/replicas/stats'):
+            self.assertEqual(self.client().get(url).status_code, 401, url)
+            self.assertEqual(self.client().get(url, headers=reader)
+                             .status_code, 403, url)
+            self.assertEqual(self.client().get(url, headers=self.headers)
+                             .status_code, 200, url)
+
+
+class BenchmarkCoverageTest(ApiTestCase):
+
+    def test_every_route_has_a_benchmark_scenario(self):
+        self.assertEqual(uncovered_routes(self.app), [])
+
+
+class ExportTest(ApiTestCase):
+    """Export endpoints stream the whole table as NDJSON"""
+
+    def test_export_books(self):
+        self.seed(authors=2, books_per_author=600)
+
+        res = self.client().get('/books/export', headers=self.headers,
+                                buffered=False)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+
+        lines = res.get_data(as_text=True).splitlines()
+        rows = [json.loads(line) for line in lines]
+
+        self.assertEqual([row['id'] for row in rows], list(range(1, 1201)))
+        self.assertEqual(rows[0]['author'], 'author0')
+        self.assertEqual(rows[-1]['author_id'], 2)
+
+    def test_export_authors(self):
+        self.seed(authors=3, books_per_author=0)
+
+        res = self.client().get('/authors/export', headers=self.headers)
+        rows = [json.loads(line) for line in res.get_data(as_text=True)
+                .splitlines()]
+
+        self.assertEqual([row['name'] for row in rows],
+                         ['author0', 'author1', 'author2'])
+        self.assertIn('full_name', rows[0])
+
+
+class BulkCreateTest(ApiTestCase):
+    """Bulk create endpoints validate the whole array up front"""
+
+    def test_bulk_create_books(self):
+        self.seed(authors=2, books_per_author=0)
+        books = [{
+            "title": "book%d" % i,
+            "description": "desc",
+            "release_date": "2022/03/09",
+            "author_id": i % 2 + 1
+        } for i in range(300)]
+
+        res, count = self.count_queries('post', '/books/bulk', json=books)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['created'], 300)
+        self.assertEqual(Book.query.count(), 300)
+        # author lookup + executemany insert + change revision (UPDATE
+        # and SELECT, one UPDATE ... RETURNING on Postgres) + revision bump
+        self.assertEqual(count, 5)
+
+    def test_bulk_create_books_reports_failed_rows(self):
+        self.seed(authors=1, books_per_author=0)
+        books = [
+            {"title": "ok", "release_date": "2022/03/09", "author_id": 1},
+            {"title": "", "release_date": "2022/03/09", "author_id": 1},
+            {"title": "x", "release_date": "2022/03/09", "author_id": 99},
+            {"title": "x", "release_date": "09-03-2022", "author_id": 1},
+            "not an object",
+            {"title": "x", "release_date": "2022/03/09", "author_id": True},
+            {"title": "x", "release_date": "2022/03/09", "author_id": 2 ** 70}
+        ]
+
+        res = self.client().post('/books/bulk', json={"books": books},
+                                 headers=self.headers)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([e['index'] for e in data['errors']],
+                         [1, 2, 3, 4, 5, 6])
+        self.assertEqual(Book.query.count(), 0)
+
+    def test_bulk_create_authors(self):
+        authors = [{"name": "a%d" % i, "full_name": "A %d" % i,
+                    "dob": "1970/01/01"} for i in range(50)]
+
+        res = self.client().post('/authors/bulk', json=authors,
+                                 headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Author.query.count(), 50)
+
+        res = self.client().post('/authors/bulk', json=[{"name": "a"}],
+                                 headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['errors'][0]['index'], 0)
+
+    def test_bulk_rejects_empty_body(self):
+        res = self.client().post('/books/bulk', json=[],
+                                 headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_bulk_rejects_ids_out_of_range(self):
+        for ids in ([0], [2 ** 31]):
+            res = self.client().delete('/books/bulk', json={"ids": ids},
+                                       headers=self.headers)
+            self.assertEqual(res.status_code, 400, ids)
+
+
+class BulkEditDeleteTest(ApiTestCase):
+    """Bulk PATCH/DELETE run set-based statements in one transaction"""
+
+    def test_reassign_books_to_another_author(self):
+        self.seed(authors=2, books_per_author=3)
+
+        res, count = self.count_queries('patch', '/books/bulk', json={
+            "ids": [1, 2, 3, 99],
+            "author_id": 2,
+            "release_date": "2021/01/02"
+        })
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['books'], [1, 2, 3])
+        self.assertEqual(data['missing'], [99])
+        # author check + existing ids + change revision (2) + one UPDATE
+        # + revision bump
+        self.assertEqual(count, 6)
+        self.assertEqual(Book.query.filter_by(author_id=2).count(), 6)
+        self.assertEqual(Book.query.get(1).release_date, date(2021, 1, 2))
+
+    def test_bulk_edit_validates_like_single_edit(self):
+        self.seed(authors=1, books_per_author=2)
+
+        for body in ({"ids": [1], "release_date": "2021-01-02"},
+                     {"ids": [1], "author_id": 42},
+                     {"ids": [1], "author_id": True},
+                     {"ids": [1]},
+                     {"ids": ["1"], "title": "x"},
+                     {"title": "x"}):
+            res = self.client().patch('/books/bulk', json=body,
+                                      headers=self.headers)
+            self.assertEqual(res.status_code, 400, body)
+
+    def test_bulk_edit_authors(self):
+        self.seed(authors=3, books_per_author=0)
+
+        res = self.client().patch('/authors/bulk', json={
+            "ids": [1, 3], "full_name": "Renamed"
+        }, headers=self.headers)
+
+        self.assertEqual(res.get_json()['authors'], [1, 3])
+        self.assertEqual(
+            [a.full_name for a in Author.query.order_by(Author.id)],
+            ['Renamed', 'Author 1', 'Renamed'])
+
+    def test_bulk_delete_books(self):
+        self.seed(authors=1, books_per_author=5)
+
+        res = self.client().delete('/books/bulk', json={"ids": [2, 4, 7]},
+                                   headers=self.headers)
+        data = res.get_json()
+
+        self.assertEqual(data['books'], [2, 4])
+        self.assertEqual(data['missing'], [7])
+        self.assertEqual(Book.query.count(), 3)
+
+    def test_bulk_delete_authors_detaches_books(self):
+        self.seed(authors=2, books_per_author=2)
+
+        res = self.client().delete('/authors/bulk', json={"ids": [1]},
+                                   headers=self.headers)
+
+        self.assertEqual(res.get_json()['authors'], [1])
+        self.assertEqual(Author.query.count(), 1)
+        self.assertEqual(Book.query.filter_by(author_id=None).count(), 2)
+
+
+class BatchGetTest(ApiTestCase):
+    """?ids= fetches many records in a constant number of queries"""
+
+    def test_books_by_ids_in_request_order(self):
+        self.seed(authors=2, books_per_author=3)
+
+        res, count = self.count_queries('get', '/books?ids=5,1,42,3,1')
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([b['id'] for b in data['books']], [5, 1, 3])
+        self.assertEqual(data['books'][0]['author'], 'author1')
+        self.assertIn('description', data['books'][0])
+        self.assertEqual(data['missing'], [42])
+        # catalog revision lookup + books joined with their authors
+        self.assertEqual(count, 2)
+
+    def test_authors_by_ids_with_book_counts(self):
+        self.seed(authors=4, books_per_author=2)
+        _, small = self.count_queries('get', '/authors?ids=2')
+
+        res, large = self.count_queries('get', '/authors?ids=4,2,9,1')
+        data = res.get_json()
+
+        self.assertEqual([a['id'] for a in data['authors']], [4, 2, 1])
+        self.assertEqual([a['number_of_books'] for a in data['authors']],
+                         [2, 2, 2])
+        self.assertEqual(data['missing'], [9])
+        self.assertEqual(small, large)
+
+    def test_rejects_malformed_ids(self):
+        for ids in ('1,x', '0', '99999999999999999999999'):
+            for route in ('/books', '/authors'):
+                res = self.client().get(route + '?ids=' + ids,
+                                        headers=self.headers)
+                self.assertEqual(res.status_code, 400, (route, ids))
+
+
+class ResponseCacheTest(ApiTestCase):
+    """Read responses are cached and evicted by the write handlers"""
+
+    config = {"CACHE_TYPE": "local"}
+    # Local entries expire on any write to their tables, since other
+    # workers' writes are only visible through the catalog revisions
+    unrelated = 'MISS'
+
+    def get(self, url):
+        res, count = self.count_queries('get', url)
+        self.assertEqual(res.status_code, 200)
+        return res, count
+
+    def test_repeat_reads_are_served_from_cache(self):
+        self.seed(authors=2, books_per_author=2)
+
+        res, count = self.get('/books')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertGreater(count, 0)
+
+        res, count = self.get('/books')
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        # only the catalog revision lookup
+        self.assertEqual(count, 1)
+        self.assertEqual(len(res.get_json()['books']), 4)
+
+        stats = self.client().get('/cache/stats',
+                                  headers=self.headers).get_json()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_book_edit_evicts_book_author_and_lists(self):
+        self.seed(authors=2, books_per_author=2)
+        urls = ['/books', '/books/1', '/authors/1', '/books/author/1',
+                '/books/3', '/authors/2', '/authors']
+        for url in urls:
+            self.get(url)
+
+        res = self.client().patch('/books/1', json={"title": "edited"},
+                                  headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+
+        status = {url: self.get(url)[0].headers['X-Cache'] for url in urls}
+        self.assertEqual(status, {
+            '/books': 'MISS',
+            '/books/1': 'MISS',
+            '/authors/1': 'MISS',
+            '/books/author/1': 'MISS',
+            '/books/3': self.unrelated,
+            '/authors/2': self.unrelated,
+            '/authors': 'MISS'
+        })
+        self.assertEqual(self.get('/books/1')[0].get_json()['books'][0]
+                         ['title'], 'edited')
+
+    def test_reassigning_book_evicts_both_authors(self):
+        self.seed(authors=3, books_per_author=1)
+        for url in ('/authors/1', '/authors/2', '/authors/3'):
+            self.get(url)
+
+        self.client().patch('/books/1', json={"author_id": 2},
+                            headers=self.headers)
+
+        self.assertEqual(self.get('/authors/1')[0].headers['X-Cache'],
+                         'MISS')
+        res = self.get('/authors/2')[0]
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(res.get_json()['authors'][0]['number_of_books'], 2)
+        self.assertEqual(self.get('/authors/3')[0].headers['X-Cache'],
+                         self.unrelated)
+
+    def test_author_rename_evicts_book_views(self):
+        self.seed(authors=1, books_per_author=1)
+        self.get('/books/1')
+        self.get('/books')
+
+        self.client().patch('/authors/1', json={"name": "renamed"},
+                            headers=self.headers)
+
+        res = self.get('/books/1')[0]
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(res.get_json()['books'][0]['author'], 'renamed')
+        self.assertEqual(self.get('/books')[0].headers['X-Cache'], 'MISS')
+
+    def test_errors_are_not_cached(self):
+        self.client().get('/books/1', headers=self.headers)
+        self.seed(authors=1, books_per_author=1)
+
+        self.assertEqual(self.get('/books/1')[0].headers['X-Cache'], 'MISS')
+
+    def test_all_is_never_served_from_cache_without_permission(self):
+        viewer = {"Authorization": "Bearer " + self.signer.token(
+            ['get:books', 'get:authors'])}
+
+        for url in ('/books?all=true', '/authors?all=true'):
+            self.assertEqual(self.client().get(url, headers=self.headers)
+                             .status_code, 200, url)
+            res = self.client().get(url, headers=viewer)
+            self.assertEqual(res.status_code, 403, url)
+
+
+class SharedResponseCacheTest(ResponseCacheTest):
+    """Shared tags see every write, so unrelated entries survive"""
+
+    unrelated = 'HIT'
+
+    def setUp(self):
+        self.config = {"CACHE_TYPE": "redis", "CACHE_CLIENT": FakeRedis()}
+        super().setUp()
+
+
+class CrossWorkerCacheTest(ApiTestCase):
+    """A worker's local cache never outlives another worker's write"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                self.directory.name, 'catalog.db'),
+            'CACHE_TYPE': 'local'
+        }
+        super().setUp()
+        self.other = create_app(dict(self.app.config))
+        self.seed(authors=1, books_per_author=1)
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def get(self, app, **headers):
+        headers.update(self.headers)
+        return app.test_client().get('/authors/1', headers=headers)
+
+    def test_write_on_one_worker_reaches_the_other(self):
+        self.assertEqual(self.get(self.other).headers['X-Cache'], 'MISS')
+        stale = self.get(self.other)
+        self.assertEqual(stale.headers['X-Cache'], 'HIT')
+
+        res = self.client().patch('/authors/1', json={'name': 'new'},
+                                  headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.get(self.other)
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(res.get_json()['authors'][0]['name'], 'new')
+        self.assertNotEqual(res.headers['ETag'], stale.headers['ETag'])
+
+        res = self.get(self.other, **{'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+        res = self.get(self.other,
+                       **{'If-None-Match': stale.headers['ETag']})
+        self.assertEqual(res.status_code, 200)
+
+
+class ConditionalGetTest(ApiTestCase):
+    """Read routes emit validators and answer 304 without querying"""
+
+    def test_if_none_match_returns_304_without_querying(self):
+        self.seed(authors=2, books_per_author=2)
+
+        res = self.client().get('/books', headers=self.headers)
+        etag = res.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertIn('Last-Modified', res.headers)
+
+        headers = dict(self.headers, **{'If-None-Match': etag})
+        self.statements = []
+        res = self.client().get('/books', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(len(self.statements), 1)
+        self.assertIn('catalog_revisions', self.statements[0])
+
+    def test_write_changes_the_etag(self):
+        self.seed(authors=1, books_per_author=1)
+        etag = self.client().get('/authors/1', headers=self.headers) \
+            .headers['ETag']
+
+        self.client().patch('/books/1', json={"title": "edited"},
+                            headers=self.headers)
+
+        headers = dict(self.headers, **{'If-None-Match': etag})
+        res = self.client().get('/authors/1', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_if_modified_since(self):
+        self.seed(authors=1, books_per_author=1)
+        last_modified = self.client().get('/authors', headers=self.headers) \
+            .headers['Last-Modified']
+
+        headers = dict(self.headers, **{'If-Modified-Since': last_modified})
+        res = self.client().get('/authors', headers=headers)
+        self.assertEqual(res.status_code, 304)
+
+    def test_errors_have_no_validators(self):
+        res = self.client().get('/books/1', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        self.assertNotIn('ETag', res.headers)
+
+
+class ChangeFeedTest(ApiTestCase):
+    """GET /changes returns only what changed since the token"""
+
+    def changes(self, since=None, limit=None):
+        url = '/changes?'
+        if since:
+            url += 'since=' + since + '&'
+        if limit:
+            url += 'limit=%d' % limit
+        res = self.client().get(url, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_initial_sync_then_only_delta(self):
+        self.seed(authors=2, books_per_author=3)
+
+        data = self.changes()
+        self.assertEqual(len(data['books']), 6)
+        self.assertEqual(len(data['authors']), 2)
+        self.assertFalse(data['has_more'])
+
+        token = data['next_token']
+        self.assertEqual(self.changes(token)['books'], [])
+
+        self.client().patch('/books/2', json={"title": "edited"},
+                            headers=self.headers)
+        self.client().delete('/books/5', headers=self.headers)
+
+        data = self.changes(token)
+        self.assertEqual([b['id'] for b in data['books']], [2])
+        self.assertEqual(data['books'][0]['title'], 'edited')
+        self.assertEqual(data['authors'], [])
+        self.assertEqual(data['deleted'], [{'table': 'books', 'id': 5}])
+
+        self.assertEqual(self.changes(data['next_token'])['deleted'], [])
+
+    def test_pages_through_changes(self):
+        self.seed(authors=1, books_per_author=5)
+
+        seen, token = [], None
+        while True:
+            data = self.changes(token, limit=2)
+            seen.extend(b['id'] for b in data['books'])
+            token = data['next_token']
+            if not data['has_more']:
+                break
+
+        self.assertEqual(seen, [1, 2, 3, 4, 5])
+
+    def test_author_delete_reports_tombstone_and_detached_books(self):
+        self.seed(authors=1, books_per_author=2)
+        token = self.changes()['next_token']
+
+        self.client().delete('/authors/bulk', json={"ids": [1]},
+                             headers=self.headers)
+
+        data = self.changes(token)
+        self.assertEqual(data['deleted'], [{'table': 'authors', 'id': 1}])
+        self.assertEqual([b['author_id'] for b in data['books']],
+                         [None, None])
+
+    def test_positions_do_not_depend_on_the_clock(self):
+        self.seed(authors=1, books_per_author=2)
+        token = self.changes()['next_token']
+
+        # A row stamped with an older time than the token has seen
+        book = Book.query.get(2)
+        book.title = 'late'
+        book.updated_at = datetime(2000, 1, 1)
+        book.update()
+
+        data = self.changes(token)
+        self.assertEqual([b['title'] for b in data['books']], ['late'])
+
+    def test_one_transaction_shares_one_revision(self):
+        self.seed(authors=1, books_per_author=3)
+        self.assertEqual({book.revision for book in Book.query},
+                         {Author.query.get(1).revision})
+
+        self.client().patch('/books/bulk', headers=self.headers, json={
+            'ids': [1, 3], 'title': 'same'})
+        revisions = {book.id: book.revision for book in Book.query}
+        self.assertEqual(revisions[1], revisions[3])
+        self.assertGreater(revisions[1], revisions[2])
+
+    def test_requires_author_permission(self):
+        headers = {'Authorization': 'Bearer ' + self.signer.token(
+            ['get:books'])}
+        res = self.client().get('/changes', headers=headers)
+        self.assertEqual(res.status_code, 403)
+
+    def test_rejects_malformed_token(self):
+        res = self.client().get('/changes?since=garbage',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+        for books in ([10 ** 25, 0], [0, 10 ** 25], [-1, 0]):
+            token = encode_token(dict(initial_position(), books=books))
+            res = self.client().get('/changes?since=' + token,
+                                    headers=self.headers)
+            self.assertEqual(res.status_code, 400, books)
+
+
+class IndexUsageTest(ApiTestCase):
+    """EXPLAIN shows the hot queries using their indexes"""
+
+    def explain(self, query):
+        statement = query.statement.compile(
+            db.engine, compile_kwargs={"literal_binds": True})
+
+        if db.engine.dialect.name == 'sqlite':
+            rows = db.session.execute('EXPLAIN QUERY PLAN %s' % statement)
+            return ' '.join(str(row[-1]) for row in rows)
+
+        rows = db.session.execute('EXPLAIN %s' % statement)
+        return ' '.join(row[0] for row in rows)
+
+    def setUp(self):
+        super().setUp()
+        self.seed(authors=20, books_per_author=20)
+        # Spread the dates so the planner sees a selective index
+        for book in Book.query:
+            book.release_date = date(2000, 1, 1) + timedelta(days=book.id)
+        db.session.commit()
+        db.session.execute('ANALYZE')
+
+    def test_books_by_author_uses_author_index(self):
+        plan = self.explain(Book.query.filter_by(author_id=3))
+        self.assertIn('ix_books_author_id', plan)
+
+        plan = self.explain(db.session.query(db.func.count(Book.id))
+                            .filter(Book.author_id == 3))
+        self.assertIn('ix_books_author_id', plan)
+
+    def test_title_and_name_lookup_use_indexes(self):
+        plan = self.explain(Book.query.filter(Book.title == 'book1-1'))
+        self.assertIn('ix_books_title', plan)
+
+        plan = self.explain(Author.query.filter(Author.name == 'author1'))
+        self.assertIn('ix_authors_name', plan)
+
+    def test_release_date_sort_uses_index(self):
+        plan = self.explain(
+            Book.query.order_by(Book.release_date, Book.id).limit(10))
+        self.assertIn('ix_books_release_date_id', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_cursor_pages_seek_the_sort_index(self):
+        for cursor, descending in (([date(2020, 1, 1), 5], False),
+                                   ([date(2020, 1, 1), 5], True),
+                                   ([None, 5], False), (None, False)):
+            order = [Book.release_date.desc(), Book.id.desc()] \
+                if descending else [Book.release_date, Book.id]
+            for criteria in segments(
+                    [Book.release_date, Book.id], cursor, descending):
+                plan = self.explain(Book.query.filter(*criteria)
+                                    .order_by(*order).limit(10))
+                self.assertIn('SEARCH', plan)
+                self.assertIn('ix_books_release_date_id', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+
+class SearchTest(ApiTestCase):
+    """Ranked, paginated search with the SQLite fallback"""
+
+    def setUp(self):
+        super().setUp()
+        for name, full_name in (('Jack', 'Jack Borrow'),
+                                ('Tommy', 'Tommy Jackson'),
+                                ('Anna', 'Anna Smith')):
+            db.session.add(Author(name, full_name, date(1970, 1, 1)))
+        db.session.flush()
+        for title in ('REST API Design Rulebook', 'Designing Data Apps',
+                      'The Art of Design', 'Cooking 100%', 'Unrelated'):
+            db.session.add(Book(title, 'desc', date(2020, 1, 1), 1))
+        db.session.commit()
+
+    def search(self, url):
+        res = self.client().get(url, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_books_ranked_by_match_quality(self):
+        data = self.search('/books/search?q=design')
+
+        self.assertEqual([b['title'] for b in data['books']], [
+            'Designing Data Apps',
+            # Equal scores fall back to the newest book first
+            'The Art of Design',
+            'REST API Design Rulebook'
+        ])
+        self.assertEqual(data['books'][0]['author'], 'Jack')
+
+    def test_authors_match_name_or_full_name(self):
+        data = self.search('/authors/search?q=jack')
+
+        self.assertEqual([a['name'] for a in data['authors']],
+                         ['Jack', 'Tommy'])
+
+    def test_search_is_paginated(self):
+        titles, url = [], '/books/search?q=design&limit=2'
+        while True:
+            data = self.search(url)
+            titles.extend(b['title'] for b in data['books'])
+            if data['next_cursor'] is None:
+                break
+            url = '/books/search?q=design&limit=2&cursor=' + \
+                data['next_cursor']
+
+        self.assertEqual(len(titles), 3)
+        self.assertEqual(len(set(titles)), 3)
+
+    def test_wildcards_are_literal(self):
+        data = self.search('/books/search?q=100%25')
+        self.assertEqual([b['title'] for b in data['books']],
+                         ['Cooking 100%'])
+
+        self.assertEqual(self.search('/books/search?q=_')['books'], [])
+
+    def test_requires_query(self):
+        for url in ('/books/search', '/books/search?q=%20',
+                    '/authors/search?q=' + 'x' * 101):
+            res = self.client().get(url, headers=self.headers)
+            self.assertEqual(res.status_code, 400, url)
+
+    def test_trigram_score_is_a_double(self):
+        # The cursor carries the score as a float8; a ``real`` would not
+        # compare equal to it at page edges.
+        with unittest.mock.patch('database.search._uses_trigrams',
+                                 return_value=True):
+            score = search._score([Author.name, Author.full_name], 'jack')
+        sql = str(score.compile(dialect=postgresql.dialect()))
+        self.assertTrue(sql.startswith('CAST(greatest(word_similarity('),
+                        sql)
+        self.assertTrue(sql.endswith('AS FLOAT(53))'), sql)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
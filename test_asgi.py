@@ -0,0 +1,204 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+from datetime import date
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bookstore.test')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bookstore-test')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.util import await_only
+
+from app import create_app
+from asgi import create_asgi_app, async_database_url
+from auth import auth
+from auth.jwks import AsyncJWKSKeyStore, JWKSKeyStore
+from auth.testing import LocalSigner
+from database.models import db, Book, Author
+
+PERMISSIONS = ['get:books', 'get:authors', 'post:authors']
+
+
+async def call(app, method, path, headers=None, body=b''):
+    """Drive one request through an ASGI app; return (status, body)."""
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': query.encode(),
+        'headers': [(name.lower().encode(), value.encode())
+                    for name, value in (headers or {}).items()],
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 12345)
+    }
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    status = sent[0]['status']
+    return status, b''.join(message.get('body', b'')
+                            for message in sent[1:])
+
+
+class AsgiTest(unittest.TestCase):
+    """The ASGI mode serves the same routes on async drivers"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.signer = LocalSigner(auth.AUTH0_DOMAIN, auth.API_AUDIENCE)
+        cls._saved_store = auth.jwks_store
+        cls.headers = {
+            'Authorization': 'Bearer ' + cls.signer.token(PERMISSIONS)
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        auth.jwks_store = cls._saved_store
+        auth.token_cache.clear()
+        cls.signer.close()
+
+    def setUp(self):
+        auth.token_cache.clear()
+        auth.jwks_store = JWKSKeyStore(self.signer.jwks_url)
+        auth.jwks_store.add_listener(auth.token_cache.evict_kids)
+
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'catalog.db')
+
+        seed = create_engine('sqlite:///' + path)
+        db.Model.metadata.create_all(seed)
+        with seed.begin() as connection:
+            connection.execute(Author.__table__.insert(), [
+                {'name': 'author%d' % i, 'full_name': 'Author %d' % i,
+                 'dob': date(1970, 1, 1)} for i in range(1, 4)])
+            connection.execute(Book.__table__.insert(), [
+                {'title': 'book%d' % i, 'description': 'desc',
+                 'release_date': date(2020, 1, 1), 'author_id': i % 3 + 1}
+                for i in range(1, 7)])
+        seed.dispose()
+
+        self.app = create_asgi_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+            'CACHE_TYPE': 'none'
+        })
+        self.flask_app = self.app.wsgi_app
+
+    def tearDown(self):
+        with self.flask_app.app_context():
+            db.get_engine().dispose()
+        self.directory.cleanup()
+
+    def request(self, *args, **kwargs):
+        return asyncio.run(call(self.app, *args, **kwargs))
+
+    def test_uses_async_drivers(self):
+        self.assertEqual(
+            self.flask_app.config['SQLALCHEMY_DATABASE_URI'][:17],
+            'sqlite+aiosqlite:')
+        self.assertEqual(async_database_url('postgresql://u@h/db'),
+                         'postgresql+asyncpg://u@h/db')
+        self.assertEqual(async_database_url('sqlite+aiosqlite://'),
+                         'sqlite+aiosqlite://')
+
+    def test_reads_and_writes(self):
+        status, body = self.request('GET', '/books?limit=2&sort=title',
+                                    headers=self.headers)
+        self.assertEqual(status, 200)
+        data = json.loads(body)
+        self.assertEqual([b['title'] for b in data['books']],
+                         ['book1', 'book2'])
+        self.assertEqual(data['books'][0]['author'], 'author2')
+
+        status, body = self.request(
+            'POST', '/authors', body=json.dumps({
+                'name': 'new', 'full_name': 'New', 'dob': '1990/01/01'
+            }).encode(), headers=dict(self.headers, **{
+                'Content-Type': 'application/json'}))
+        self.assertEqual(status, 200)
+
+        status, body = self.request('GET', '/authors', headers=self.headers)
+        self.assertEqual([a['name'] for a in json.loads(body)['authors']],
+                         ['author1', 'author2', 'author3', 'new'])
+
+    def test_auth_errors_are_unchanged(self):
+        status, body = self.request('GET', '/books')
+        self.assertEqual(status, 401)
+
+        status, _ = self.request('POST', '/books', headers=self.headers)
+        self.assertEqual(status, 403)
+
+    def test_streams_export(self):
+        status, body = self.request('GET', '/books/export',
+                                    headers=self.headers)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body.decode().splitlines()), 6)
+
+    def test_slow_queries_do_not_block_other_requests(self):
+        with self.flask_app.app_context():
+            engine = db.get_engine()
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def network_latency(*args):
+            await_only(asyncio.sleep(0.1))
+
+        async def burst():
+            return await asyncio.gather(*[
+                call(self.app, 'GET', '/books', headers=self.headers)
+                for _ in range(10)])
+
+        started = time.perf_counter()
+        results = asyncio.run(burst())
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual([status for status, _ in results], [200] * 10)
+        # Two queries per request (revisions, books): ~0.2s when the
+        # requests overlap, ~2s if each one blocked the loop.
+        self.assertLess(elapsed, 1.0)
+
+    def test_concurrent_requests_share_one_key_fetch(self):
+        async def burst():
+            return await asyncio.gather(*[
+                call(self.app, 'GET', '/authors', headers=self.headers)
+                for _ in range(5)])
+
+        results = asyncio.run(burst())
+
+        self.assertEqual([status for status, _ in results], [200] * 5)
+        self.assertEqual(
+            self.flask_app.extensions['jwks_store'].fetch_count, 1)
+
+    def test_sync_app_keeps_the_blocking_key_store(self):
+        self.assertIsInstance(self.flask_app.extensions['jwks_store'],
+                              AsyncJWKSKeyStore)
+        self.assertIsInstance(auth.jwks_store, JWKSKeyStore)
+        self.assertNotIsInstance(auth.jwks_store, AsyncJWKSKeyStore)
+
+        sync_app = create_app({
+            'SQLALCHEMY_DATABASE_URI':
+                self.flask_app.config['SQLALCHEMY_DATABASE_URI']
+                .replace('+aiosqlite', ''),
+            'CACHE_TYPE': 'none'
+        })
+        res = sync_app.test_client().get('/authors', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        with sync_app.app_context():
+            db.get_engine().dispose()
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import os
+import unittest
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bookstore.test')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bookstore-test')
+
+from auth import auth
+from auth.auth import AuthError, authenticate, check_principal, \
+    verify_decode_jwt
+from auth.jwks import JWKSKeyStore, JWKSUnavailableError
+from auth.testing import LocalSigner
+from auth.token_cache import VerifiedTokenCache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class JWKSKeyStoreTest(unittest.TestCase):
+    """Exercises the JWKS cache against a local JWKS file"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.signer = LocalSigner(auth.AUTH0_DOMAIN, auth.API_AUDIENCE)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.signer.close()
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = JWKSKeyStore(self.signer.jwks_url, ttl=600,
+                                  min_refresh_interval=30, clock=self.clock)
+        self.store.add_listener(auth.token_cache.evict_kids)
+
+        self._saved = auth.jwks_store
+        auth.jwks_store = self.store
+        auth.token_cache.clear()
+
+    def tearDown(self):
+        auth.jwks_store = self._saved
+        auth.token_cache.clear()
+
+    def test_fetches_once_within_ttl(self):
+        token = self.signer.token(['get:books'])
+
+        for _ in range(5):
+            payload = verify_decode_jwt(token)
+
+        self.assertEqual(payload['permissions'], ['get:books'])
+        self.assertEqual(self.store.fetch_count, 1)
+
+    def test_refetches_after_ttl(self):
+        self.store.get_key(self.signer.kid)
+        self.clock.now += 601
+        self.store.get_key(self.signer.kid)
+
+        self.assertEqual(self.store.fetch_count, 2)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        self.store.get_key(self.signer.kid)
+        self.clock.now += 31
+
+        for i in range(10):
+            self.assertIsNone(self.store.get_key('forged-%d' % i))
+
+        self.assertEqual(self.store.fetch_count, 2)
+
+    def test_unknown_kid_picks_up_rotated_key(self):
+        old_kid = self.signer.kid
+        self.store.get_key(old_kid)
+        self.clock.now += 31
+
+        new_kid = self.signer.rotate(keep_old=True)
+        try:
+            self.assertIsNotNone(self.store.get_key(new_kid))
+        finally:
+            self.signer.rotate(old_kid)
+
+    def test_serves_stale_keys_when_fetch_fails(self):
+        self.store.get_key(self.signer.kid)
+        self.store.url = 'file:///nonexistent/jwks.json'
+        self.clock.now += 601
+
+        self.assertIsNotNone(self.store.get_key(self.signer.kid))
+        self.assertEqual(self.store.fetch_failures, 1)
+
+    def test_unavailable_without_keys(self):
+        self.store.url = 'file:///nonexistent/jwks.json'
+
+        with self.assertRaises(JWKSUnavailableError):
+            self.store.get_key(self.signer.kid)
+
+        token = self.signer.token(['get:books'])
+        with self.assertRaises(AuthError) as ctx:
+            verify_decode_jwt(token)
+        self.assertEqual(ctx.exception.status_code, 503)
+
+    def test_unknown_key_rejected(self):
+        other = LocalSigner(auth.AUTH0_DOMAIN, auth.API_AUDIENCE)
+        try:
+            with self.assertRaises(AuthError) as ctx:
+                verify_decode_jwt(other.token(['get:books']))
+        finally:
+            other.close()
+
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+class VerifiedTokenCacheTest(unittest.TestCase):
+    """Exercises the verified-token LRU"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.signer = LocalSigner(auth.AUTH0_DOMAIN, auth.API_AUDIENCE)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.signer.close()
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = JWKSKeyStore(self.signer.jwks_url, clock=self.clock)
+        self.cache = VerifiedTokenCache(maxsize=2, max_age=600)
+        self.store.add_listener(self.cache.evict_kids)
+
+        self._saved = auth.jwks_store, auth.token_cache
+        auth.jwks_store, auth.token_cache = self.store, self.cache
+
+    def tearDown(self):
+        auth.jwks_store, auth.token_cache = self._saved
+
+    def test_repeat_token_is_a_hit(self):
+        token = self.signer.token(['get:books'])
+
+        first = verify_decode_jwt(token)
+        second = verify_decode_jwt(token)
+
+        self.assertIs(first, second)
+        self.assertIsInstance(authenticate(token).permissions, frozenset)
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_lru_is_bounded(self):
+        tokens = [self.signer.token(['get:books'], jti=str(i))
+                  for i in range(3)]
+        for token in tokens:
+            verify_decode_jwt(token)
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertIsNone(self.cache.get(tokens[0]))
+
+    def test_entry_expires_with_token(self):
+        clock = FakeClock()
+        cache = VerifiedTokenCache(maxsize=4, max_age=600, clock=clock)
+        cache.put('token', {}, 'kid', exp=clock.now + 10)
+
+        self.assertIsNotNone(cache.get('token'))
+        clock.now += 10
+        self.assertIsNone(cache.get('token'))
+
+    def test_rotated_key_drops_entries(self):
+        old_kid = self.signer.kid
+        token = self.signer.token(['get:books'])
+        verify_decode_jwt(token)
+        self.assertEqual(len(self.cache), 1)
+
+        self.signer.rotate()
+        try:
+            self.store.refresh()
+            self.assertEqual(len(self.cache), 0)
+
+            with self.assertRaises(AuthError):
+                verify_decode_jwt(token)
+        finally:
+            self.signer.rotate(old_kid)
+
+    def test_principal_permission_checks(self):
+        principal = authenticate(self.signer.token(['get:books']))
+
+        self.assertTrue(check_principal('get:books', principal))
+        with self.assertRaises(AuthError) as ctx:
+            check_principal('delete:books', principal)
+        self.assertEqual(ctx.exception.status_code, 403)
+
+        principal = authenticate(self.signer.token(permissions=None))
+        with self.assertRaises(AuthError) as ctx:
+            check_principal('get:books', principal)
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()